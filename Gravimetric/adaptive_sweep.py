@@ -0,0 +1,96 @@
+"""
+Picks the plunger distances of an adaptive Gravimetric sweep.
+
+The sweep starts on a coarse grid, then keeps halving the interval next to
+the measured point the piecewise-linear uL/mm model predicts worst from
+its neighbours (its leave-one-out residual, large where the curve bends).
+It stops once every residual is within tolerance, intervals reach the
+smallest step or the point budget is spent. The budget defaults to the
+points of a fixed grid sweep, so the sweep never costs more than one:
+
+    sweep = AdaptiveSweep(max_distance=17.4)
+    distance = sweep.next_distance()
+    while distance is not None:
+        sweep.add(distance, measure(distance))
+        distance = sweep.next_distance()
+
+"""
+import numpy as np
+
+DEFAULT_INITIAL_POINTS = 4
+DEFAULT_TOLERANCE = 0.2     # uL
+DEFAULT_MIN_STEP = 0.25     # mm
+# pip_test's default --aspir_incre, sets the default point budget
+DEFAULT_GRID_STEP = 1       # mm
+DISTANCE_DECIMALS = 2
+# distances are rounded, closer points could not be told apart
+SMALLEST_STEP = 10 ** -DISTANCE_DECIMALS
+
+
+class AdaptiveSweep:
+    def __init__(self, max_distance, tolerance=DEFAULT_TOLERANCE,
+                 initial_points=DEFAULT_INITIAL_POINTS,
+                 min_step=DEFAULT_MIN_STEP, max_points=None):
+        '''max_points defaults to the points of a DEFAULT_GRID_STEP grid,
+        the initial grid is spread over no more points than that'''
+        self.tolerance = tolerance
+        self.min_step = max(min_step, SMALLEST_STEP)
+        if max_points is None:
+            max_points = max(int(max_distance / DEFAULT_GRID_STEP), 1)
+        self.max_points = max_points
+        initial_points = min(initial_points, max_points)
+        self.points = []
+        self._grid = [
+            round(float(distance), DISTANCE_DECIMALS) for distance in
+            np.linspace(max_distance / initial_points, max_distance,
+                        initial_points)
+        ]
+
+    def add(self, distance, volume):
+        '''Records the volume (uL) measured at distance (mm)'''
+        self.points.append((distance, abs(volume)))
+        if distance in self._grid:
+            self._grid.remove(distance)
+
+    def knots(self):
+        '''Distances and mean volumes of the model, from the origin up'''
+        distances = np.array([0.0] + [d for d, _ in self.points])
+        volumes = np.array([0.0] + [v for _, v in self.points])
+        knots, index = np.unique(distances, return_inverse=True)
+        return knots, np.bincount(index, volumes) / np.bincount(index)
+
+    def residuals(self):
+        '''|measured - interpolated from the neighbours| of every knot. The
+        last knot is extrapolated from the two before it, the origin is 0'''
+        knots, volumes = self.knots()
+        residuals = np.zeros(len(knots))
+        if len(knots) > 2:
+            left, right = knots[:-2], knots[2:]
+            weight = (knots[1:-1] - left) / (right - left)
+            predicted = volumes[:-2] + weight * (volumes[2:] - volumes[:-2])
+            residuals[1:-1] = np.abs(volumes[1:-1] - predicted)
+            slope = (volumes[-2] - volumes[-3]) / (knots[-2] - knots[-3])
+            residuals[-1] = abs(
+                volumes[-1] - volumes[-2] - slope * (knots[-1] - knots[-2]))
+        return knots, residuals
+
+    def next_distance(self):
+        '''Next distance to measure, None once the sweep is done'''
+        if len(self.points) >= self.max_points:
+            return None
+        if self._grid:
+            return self._grid[0]
+        knots, residuals = self.residuals()
+        scores = np.maximum(residuals[:-1], residuals[1:])
+        midpoints = np.round((knots[:-1] + knots[1:]) / 2, DISTANCE_DECIMALS)
+        # only intervals that can still be halved into a new distance
+        scores[np.diff(knots) < 2 * self.min_step] = 0
+        scores[np.isin(midpoints, knots)] = 0
+        interval = int(np.argmax(scores))
+        if scores[interval] <= self.tolerance:
+            return None
+        return float(midpoints[interval])
+
+    @property
+    def worst_residual(self):
+        return float(self.residuals()[1].max())
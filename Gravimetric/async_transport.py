@@ -0,0 +1,63 @@
+"""
+asyncio front ends for the robot and the scale.
+
+Every device runs its blocking serial calls on its own single worker
+thread, so calls to one device stay in order while robot and scale I/O
+can overlap:
+
+    mass, _ = await asyncio.gather(
+        scale.read_mass(), robot.run(prepare_plunger, backlash))
+
+"""
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AsyncDevice:
+    '''Runs blocking calls for one device on a dedicated worker thread'''
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    async def run(self, function, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, lambda: function(*args, **kwargs))
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+
+class AsyncSmoothie(AsyncDevice):
+    '''Awaitable commands for a connected SmoothieDriver_3_0_0'''
+    def __init__(self, driver):
+        super().__init__()
+        self.driver = driver
+
+    async def send(self, command, timeout=None):
+        '''Sends a command, returning once Smoothie acknowledged it'''
+        return await self.run(self.driver._send_command, command, timeout)
+
+    async def query(self, command, timeout=None):
+        '''Sends a command and returns the data Smoothie replied with'''
+        response = await self.send(command, timeout)
+        if response is None and not self.driver.simulating:
+            raise RuntimeError('No response to "{}"'.format(command))
+        return response
+
+
+class AsyncScale(AsyncDevice):
+    '''Awaitable readings for any scale with a read_mass() method'''
+    def __init__(self, scale):
+        super().__init__()
+        self.scale = scale
+
+    async def read_mass(self):
+        return await self.run(self.scale.read_mass)
+
+    async def sample(self, interval=0):
+        '''Yields (monotonic time, mass) readings until the caller stops'''
+        while True:
+            mass = await self.read_mass()
+            yield time.monotonic(), mass
+            await asyncio.sleep(interval)
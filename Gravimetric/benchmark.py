@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+"""
+Benchmarks the driver and the test loop against local stand-ins for the
+Smoothie (virtual_smoothie at time scale 0) and the scale (SimulatedScale).
+
+    serial_commands_per_s   write_and_return round trips to the board
+    driver_moves_per_s      SmoothieDriver_3_0_0.move calls
+    driver_growth_bytes     memory the driver modules keep per 1000 moves,
+                            once the position log has wrapped around
+    import_s, connect_s     start up: importing pip_test, driver setup
+    <test>_cycles_per_hour  rig throughput of a dry run, deterministic
+    <test>_host_s_per_cycle host time a dry run cycle takes to compute
+
+Host timings are the median of the repeats, kept with their spread (the
+interquartile range relative to the median). Results are written as JSON,
+and compared with a baseline run of the same settings, exiting with
+status 1 if any metric got worse by more than the tolerance plus the
+larger spread of the two runs:
+
+    python benchmark.py -o baseline.json
+    python benchmark.py -o new.json -b baseline.json
+    python benchmark.py --options "-P -A"      # pip_test options of the runs
+
+"""
+import io
+import os
+import sys
+import json
+import time
+import shlex
+import platform
+import optparse
+import tempfile
+import statistics
+import subprocess
+import tracemalloc
+import contextlib
+
+import serial_communication
+import driver_3_0
+import virtual_smoothie
+
+HIGHER = 'higher'
+LOWER = 'lower'
+DEFAULT_REPEATS = 9
+DEFAULT_COMMANDS = 5000
+DEFAULT_MOVES = 5000
+DEFAULT_CYCLES = 50
+DEFAULT_TOLERANCE = 0.15    # relative
+# the position log is allocated once, memory is only measured after it
+# has filled up and wrapped around
+WARMUP_MOVES = driver_3_0.POSITION_LOG_CAPACITY + 1000
+# flat memory measures a few bytes either way, so growth is gated on this
+# limit instead of on its change from the baseline
+GROWTH_LIMIT = 100          # bytes per 1000 moves
+# files whose allocations count as driver memory
+DRIVER_FILES = ['driver_3_0.py', 'serial_communication.py', 'kinematics.py',
+                'ring_buffer.py']
+# test: pip_test options of its dry run, --cycles sets the cycle count
+TEST_RUNS = {
+    'const_vol': ['-t', 'Fixed', '-p', 'P10', '-d', '3', '-c', '{cycles}'],
+    'gravimetric': ['-t', 'Gravi', '-p', 'P10', '-a', '1', '-m', '{cycles}'],
+}
+SIM_SEED = 1
+
+
+def metric(value, unit, better, spread=0.0, limit=None):
+    '''limit, if given, is the value past which the metric regressed'''
+    return {'value': value, 'unit': unit, 'better': better, 'spread': spread,
+            'limit': limit}
+
+
+def median_time(function, repeats):
+    '''Median seconds of repeated calls and their relative spread'''
+    times = []
+    for _ in range(repeats):
+        started_at = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - started_at)
+    median = statistics.median(times)
+    if len(times) < 2:
+        return median, 0.0
+    low, _, high = statistics.quantiles(times, n=4)
+    return median, (high - low) / median
+
+
+@contextlib.contextmanager
+def stand_in_driver():
+    '''Driver connected to a VirtualSmoothie that acks at once, over a
+    pseudo-terminal where there is one and in-process otherwise. Yields
+    the driver and the transport name'''
+    driver = driver_3_0.SmoothieDriver_3_0_0()
+    if hasattr(os, 'openpty'):
+        smoothie = virtual_smoothie.VirtualSmoothie(time_scale=0)
+        driver.connect(port=smoothie.start())
+        try:
+            yield driver, 'pty'
+        finally:
+            driver._connection.close()
+            smoothie.stop()
+    else:
+        driver.connect_dry_run()
+        driver.virtual_smoothie.time_scale = 0
+        yield driver, 'loopback'
+
+
+def alternating_moves(driver, count):
+    for i in range(count):
+        driver.move(x=10 + i % 2, c=i % 2)
+
+
+def bench_serial(repeats, commands):
+    '''Round trips of a position query and a move that waits for motion'''
+    with stand_in_driver() as (driver, transport):
+        connection = driver._connection
+
+        def round_trips():
+            for i in range(commands // 2):
+                serial_communication.write_and_return(
+                    'M114.2', connection)
+                serial_communication.write_and_return(
+                    'G0X{} M400'.format(10 + i % 2), connection)
+
+        seconds, seconds_spread = median_time(round_trips, repeats)
+        moves, moves_spread = median_time(
+            lambda: alternating_moves(driver, commands), repeats)
+    return transport, {
+        'serial_commands_per_s': metric(
+            commands / seconds, '1/s', HIGHER, seconds_spread),
+        'driver_moves_per_s': metric(
+            commands / moves, '1/s', HIGHER, moves_spread),
+    }
+
+
+def bench_memory(moves):
+    '''Bytes the driver modules hold on to per 1000 moves, the slope
+    between the last two of three snapshots taken after the warm up, so
+    one time allocations are left out'''
+    filters = [tracemalloc.Filter(True, '*' + os.sep + name)
+               for name in DRIVER_FILES]
+    with stand_in_driver() as (driver, _):
+        tracemalloc.start()
+        try:
+            alternating_moves(driver, WARMUP_MOVES)
+            snapshots = []
+            for _ in range(3):
+                snapshots.append(
+                    tracemalloc.take_snapshot().filter_traces(filters))
+                alternating_moves(driver, moves)
+        finally:
+            tracemalloc.stop()
+    growth = sum(stat.size_diff for stat in snapshots[2].compare_to(
+        snapshots[1], 'filename'))
+    return {
+        'driver_growth_bytes': metric(growth / moves * 1000, 'B/1000 moves', LOWER, limit=GROWTH_LIMIT),
+    }
+
+
+def bench_startup(repeats):
+    here = os.path.dirname(os.path.abspath(__file__))
+    import_s, import_spread = median_time(lambda: subprocess.run(
+        [sys.executable, '-c', 'import pip_test'], cwd=here, check=True),
+        repeats)
+
+    def connect():
+        with stand_in_driver():
+            pass
+
+    connect_s, connect_spread = median_time(connect, repeats)
+    return {
+        'import_s': metric(import_s, 's', LOWER, import_spread),
+        'connect_s': metric(connect_s, 's', LOWER, connect_spread),
+    }
+
+
+def bench_cycles(repeats, cycles, options):
+    '''Dry runs every test of TEST_RUNS in a scratch folder'''
+    import pip_test
+    metrics = {}
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as folder:
+        os.chdir(folder)
+        os.mkdir('results')
+        try:
+            for test, args in TEST_RUNS.items():
+                argv = [arg.format(cycles=cycles) for arg in args] \
+                    + ['-n', '--sim_seed', str(SIM_SEED)] + options
+
+                def run():
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        pip_test.main(argv)
+
+                host_s, spread = median_time(run, repeats)
+                recorded = len(pip_test.timeline.laps)
+                metrics[test + '_cycles_per_hour'] = metric(
+                    recorded / pip_test.timeline.elapsed * 3600, '1/h', HIGHER)
+                metrics[test + '_host_s_per_cycle'] = metric(
+                    host_s / recorded, 's', LOWER, spread)
+        finally:
+            os.chdir(cwd)
+    return metrics
+
+
+def run(repeats=DEFAULT_REPEATS, commands=DEFAULT_COMMANDS,
+        moves=DEFAULT_MOVES, cycles=DEFAULT_CYCLES, options=()):
+    transport, metrics = bench_serial(repeats, commands)
+    metrics.update(bench_memory(moves))
+    metrics.update(bench_startup(repeats))
+    metrics.update(bench_cycles(repeats, cycles, list(options)))
+    return {
+        'settings': {
+            'repeats': repeats, 'commands': commands, 'moves': moves,
+            'cycles': cycles, 'options': list(options),
+            'transport': transport,
+        },
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'metrics': metrics,
+    }
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    '''Rows of (metric, baseline, new, relative change, spread, regressed)
+    for the metrics of both runs. The change is positive where the new run
+    is better, spread is the larger of the two runs' spreads. Metrics with
+    a limit only regress past it'''
+    rows = []
+    for name, new in results['metrics'].items():
+        old = baseline['metrics'].get(name)
+        if old is None:
+            continue
+        if old['value']:
+            change = (new['value'] - old['value']) / abs(old['value'])
+        else:
+            change = 0.0 if not new['value'] else float('inf')
+        if new['better'] == LOWER:
+            change = -change
+        spread = max(old.get('spread', 0.0), new.get('spread', 0.0))
+        if new.get('limit') is not None:
+            regressed = new['value'] > new['limit']
+        else:
+            regressed = change < -(tolerance + spread)
+        rows.append((name, old['value'], new['value'], change, spread,
+                     regressed))
+    return rows
+
+
+def print_metrics(results):
+    for name, entry in results['metrics'].items():
+        print("%-30s %14.4g %-14s spread %.1f%%" % (
+            name, entry['value'], entry['unit'], entry['spread'] * 100))
+
+
+def print_comparison(rows):
+    print("%-30s %14s %14s %9s %8s" % ('Metric', 'Baseline', 'New', 'Change', 'Spread'))
+    for name, old, new, change, spread, regressed in rows:
+        print("%-30s %14.4g %14.4g %+8.1f%% %7.1f%%%s" % (
+            name, old, new, change * 100, spread * 100,
+            '  REGRESSED' if regressed else ''))
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage='usage: %prog [options] ')
+    parser.add_option("-o", "--output", dest = "output", type = 'str', default = 'benchmark.json', help = "JSON file to write the results to")
+    parser.add_option("-b", "--baseline", dest = "baseline", type = 'str', default = None, help = "JSON results of an earlier run to compare with")
+    parser.add_option("-t", "--tolerance", dest = "tolerance", type = 'float', default = DEFAULT_TOLERANCE, help = "Largest relative slow down that is not a regression, on top of the measured spread")
+    parser.add_option("-r", "--repeats", dest = "repeats", type = 'int', default = DEFAULT_REPEATS, help = "Timed repeats, the median is kept")
+    parser.add_option("--commands", dest = "commands", type = 'int', default = DEFAULT_COMMANDS, help = "Commands per serial and driver timing")
+    parser.add_option("--moves", dest = "moves", type = 'int', default = DEFAULT_MOVES, help = "Moves of the memory growth run")
+    parser.add_option("--cycles", dest = "cycles", type = 'int', default = DEFAULT_CYCLES, help = "Cycles of every test dry run")
+    parser.add_option("--options", dest = "options", type = 'str', default = '', help = "pip_test options added to the test dry runs, like \"-P -A\"")
+    (options, args) = parser.parse_args(args = None, values = None)
+
+    results = run(options.repeats, options.commands, options.moves, options.cycles, shlex.split(options.options))
+    with open(options.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print_metrics(results)
+    print("Wrote", options.output)
+
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+        if baseline['settings'] != results['settings']:
+            print("Baseline settings differ, numbers may not compare:", baseline['settings'])
+        rows = compare(results, baseline, options.tolerance)
+        print_comparison(rows)
+        if any(row[-1] for row in rows):
+            raise SystemExit(1)
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+"""
+Volume to plunger distance calibration fitted from Gravimetric runs.
+
+The uL/mm sweeps of a pipette (results/Pipette_Data_*<pipette>*, test
+Gravi) are averaged per distance into a monotonic piecewise-linear
+volume(distance) curve through the origin. Its inverse is tabulated on a
+dense volume grid, so converting a volume is an index into the table.
+Fitted tables are cached in calibrations/<pipette>.npz together with the
+size and mtime of the files they came from, and refitted when those
+change. Pipette aliases are resolved through pipette_profiles.
+
+    python calibration.py -p P10            # fit and print the curve
+"""
+import os
+import optparse
+
+import numpy as np
+
+import results_catalog
+import pipette_profiles
+
+CACHE_DIR = 'calibrations'
+LUT_STEP = 0.01     # uL between table entries
+
+
+def read_sweep(path):
+    '''Returns the (distances, volumes) of one result file'''
+    distances, volumes, _ = results_catalog.read_volumes(path)
+    return distances, np.abs(volumes)
+
+
+def sweep_files(pipette, results_dir=results_catalog.RESULTS_DIR):
+    '''Gravimetric sweep result files of the pipette, oldest first'''
+    catalog = results_catalog.Catalog(results_dir)
+    catalog.refresh()
+    runs = catalog.query(
+        pipette=pipette_profiles.resolve_name(pipette), test='Gravi')
+    # plain str, os functions take numpy strings for bytes paths
+    return [str(path) for path in runs['path']]
+
+
+def _fingerprint(paths):
+    return np.array(
+        ['%s:%s:%s' % ((path,) + results_catalog.file_stat(path))
+         for path in paths])
+
+
+class Calibration:
+    def __init__(self, distances, volumes, step=LUT_STEP):
+        '''Fits volume(distance) through the mean volume of every distance'''
+        distances = np.asarray(distances, dtype=float)
+        volumes = np.asarray(volumes, dtype=float)
+        if not len(distances):
+            raise ValueError('No calibration points')
+        knots, index = np.unique(distances, return_inverse=True)
+        means = np.bincount(index, volumes) / np.bincount(index)
+        if knots[0] > 0:
+            knots = np.concatenate([[0.0], knots])
+            means = np.concatenate([[0.0], means])
+        # the plunger never delivers less for a longer stroke
+        self.distances = knots
+        self.volumes = np.maximum.accumulate(means)
+        self.step = step
+        grid = np.arange(0, self.volumes[-1] + step, step)
+        self.table = np.interp(grid, self.volumes, self.distances)
+
+    @classmethod
+    def from_table(cls, distances, volumes, table, step):
+        calibration = cls.__new__(cls)
+        calibration.distances = distances
+        calibration.volumes = volumes
+        calibration.table = table
+        calibration.step = step
+        return calibration
+
+    def distance(self, volume):
+        '''Plunger distance in mm for volume in uL. Raises ValueError for
+        volumes outside the calibrated range, which is never extrapolated'''
+        if not self.volumes[0] <= volume <= self.volumes[-1]:
+            raise ValueError('{} uL is outside the calibration, {} - {} uL'
+                             .format(volume, self.volumes[0], self.volumes[-1]))
+        index = min(int(round(volume / self.step)), len(self.table) - 1)
+        return float(self.table[index])
+
+    def volume(self, distance):
+        '''Expected volume in uL for a plunger distance in mm'''
+        return float(np.interp(distance, self.distances, self.volumes))
+
+    def save(self, file_name, sources=()):
+        np.savez(file_name, distances=self.distances, volumes=self.volumes,
+                 table=self.table, step=self.step, sources=sources)
+
+
+def fit(pipette, results_dir=results_catalog.RESULTS_DIR):
+    paths = sweep_files(pipette, results_dir)
+    if not paths:
+        raise ValueError('No Gravimetric results for {}'.format(pipette))
+    distances, volumes = zip(*(read_sweep(path) for path in paths))
+    return Calibration(np.concatenate(distances), np.concatenate(volumes))
+
+
+def load(pipette, results_dir=results_catalog.RESULTS_DIR,
+         cache_dir=CACHE_DIR):
+    '''The cached calibration of the pipette, refitted if its Gravimetric
+    result files changed since it was cached'''
+    pipette = pipette_profiles.resolve_name(pipette)
+    cache_file = os.path.join(
+        cache_dir, results_catalog.file_pipette(pipette) + '.npz')
+    paths = sweep_files(pipette, results_dir)
+    sources = _fingerprint(paths)
+    if os.path.exists(cache_file):
+        with np.load(cache_file) as cached:
+            if np.array_equal(cached['sources'], sources):
+                return Calibration.from_table(
+                    cached['distances'], cached['volumes'], cached['table'],
+                    float(cached['step']))
+    calibration = fit(pipette, results_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+    calibration.save(cache_file, sources)
+    return calibration
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage='usage: %prog [options] ')
+    parser.add_option("-p", "--p", dest = "pipette", default = 'P50', type = 'str', help = 'Pipette Type as string')
+    parser.add_option("-r", "--results", dest = "results", type = 'str', default = results_catalog.RESULTS_DIR, help = "Results folder")
+    (options, args) = parser.parse_args(args = None, values = None)
+
+    calibration = load(options.pipette, options.results)
+    for distance, volume in zip(calibration.distances, calibration.volumes):
+        print("%6.2f mm  %8.3f uL" % (distance, volume))
@@ -1,6 +1,15 @@
 import serial_communication
+import kinematics
+import ring_buffer
+import os
+import time
+import contextlib
+from collections import deque
 from os import environ
 
+import numpy as np
+from numpy import isclose
+
 PLUNGER_CURRENT_HIGH = 0.5
 PLUNGER_CURRENT_LOW = 0.1
 
@@ -19,11 +28,22 @@ HOMED_POSITION = {
     'C': 18.9997
 }
 
+# Column order of move_many targets
+WAYPOINT_AXES = 'XYZABC'
+
 HOME_SEQUENCE = ['ZABC', 'X', 'Y']
 AXES = ''.join(HOME_SEQUENCE)
 DISABLED_AXES = ''
 SEC_PER_MIN = 60
 
+# Number of unacknowledged command lines allowed in pipelined mode
+DEFAULT_PIPELINE_WINDOW = 4
+# Positions kept in SmoothieDriver_3_0_0.log, oldest are overwritten
+POSITION_LOG_CAPACITY = 10000
+POSITION_LOG_DTYPE = [('time', 'f8')] + [(axis, 'f8') for axis in 'XYZABC']
+# Combined sequence lines stay well inside Smoothie's line buffer
+MAX_LINE_LENGTH = 120
+
 GCODES = {'HOME': 'G28.2',
           'MOVE': 'G0',
           'DWELL': 'G4',
@@ -31,12 +51,49 @@ GCODES = {'HOME': 'G28.2',
           'LIMIT_SWITCH_STATUS': 'M119',
           'PROBE': 'G38.2',
           'ABSOLUTE_COORDS': 'G90',
+          'RELATIVE_COORDS': 'G91',
           'RESET_FROM_ERROR': 'M999',
           'SET_SPEED': 'G0F',
           'SET_CURRENT': 'M907',
+          'STEPS_PER_MM': 'M92',
+          'WAIT': 'M400',
           'Enable_Motors': 'M17',
           'Disable_Motors': 'M18'}
 
+# Commands that return data have to be sent synchronously, even when pipelined
+QUERY_GCODES = (GCODES['CURRENT_POSITION'], GCODES['LIMIT_SWITCH_STATUS'])
+
+
+def waypoint(x=None, y=None, z=None, a=None, b=None, c=None):
+    '''Returns a move_many target row, axes left as None do not move'''
+    return [np.nan if value is None else value for value in (x, y, z, a, b, c)]
+
+
+def _forward_fill(values, first):
+    '''Replaces NaNs in each column by the value above them, or by first'''
+    values = np.vstack([first, values])
+    rows = np.where(np.isnan(values), 0, np.arange(len(values))[:, None])
+    np.maximum.accumulate(rows, axis=0, out=rows)
+    return values[rows, np.arange(values.shape[1])][1:]
+
+
+def _pack_lines(codes):
+    '''Joins codes into as few lines of at most MAX_LINE_LENGTH as possible'''
+    lines = []
+    for code in codes:
+        if lines and len(lines[-1]) + len(code) < MAX_LINE_LENGTH:
+            lines[-1] += ' ' + code
+        else:
+            lines.append(code)
+    return lines
+
+
+def _parse_current_values(command):
+    return {
+        word[0].upper(): float(word[1:])
+        for word in command.split(' ')[1:]
+    }
+
 
 def _parse_axis_values(raw_axis_values):
     parsed_values = raw_axis_values.split(' ')
@@ -48,12 +105,31 @@ def _parse_axis_values(raw_axis_values):
 
 
 class SmoothieDriver_3_0_0:
-    def __init__(self):
+    def __init__(self, pipelined=False, window=DEFAULT_PIPELINE_WINDOW,
+                 clock=time):
+        # time module or a sim_clock.SimulatedClock for dry runs
+        self.clock = clock
         self._position = {}
-        self.log = []
+        self.log = ring_buffer.RingBuffer(
+            POSITION_LOG_DTYPE, POSITION_LOG_CAPACITY)
         self._update_position({axis: 0 for axis in AXES})
         self.simulating = True
         self._connection = None
+        self._virtual_smoothie = None
+        # In pipelined mode up to `window` command lines are written before
+        # waiting on their acks, and M400 is only sent where it is needed
+        self.pipelined = pipelined
+        self._window = window
+        self._in_flight = deque()
+        # Last current sent to each axis, so M907 is only sent on changes
+        self._currents = {}
+        self._plunger_holds = 0
+        self._relative = False
+        self._motion = kinematics.MotionModel.from_gcode(
+            DEFAULT_MAX_SPEEDS, DEFAULT_ACCELERATION)
+        self._feed_rate = None
+        # Predicted time (time.monotonic) at which all sent moves are done
+        self._motion_done_at = 0
 
     def _update_position(self, target):
         self._position.update({
@@ -61,7 +137,8 @@ class SmoothieDriver_3_0_0:
             for axis, value in target.items() if value is not None
         })
 
-        self.log += [self._position.copy()]
+        self.log.append(
+            (self.clock.time(),) + tuple(self._position[axis] for axis in 'XYZABC'))
 
     def update_position(self, default=None, is_retry=False):
         if default is None:
@@ -86,22 +163,51 @@ class SmoothieDriver_3_0_0:
 
         self._update_position(updated_position)
 
-    def connect(self):
+    def connect(self, port=None):
         self.simulating = False
         if environ.get('ENABLE_VIRTUAL_SMOOTHIE', '').lower() == 'true':
-            self.simulating = True
-            return
+            if not hasattr(os, 'openpty'):
+                # No pseudo-terminals (Windows), skip the serial layer
+                self.simulating = True
+                return
+            import virtual_smoothie
+            self._virtual_smoothie = virtual_smoothie.VirtualSmoothie(
+                time_scale=float(
+                    environ.get('VIRTUAL_SMOOTHIE_TIME_SCALE', 1.0)))
+            port = self._virtual_smoothie.start()
+
+        self._connection = serial_communication.connect(port=port)
+        self._setup()
 
-        self._connection = serial_communication.connect()
+    def connect_dry_run(self):
+        '''Connects to a VirtualSmoothie in this process that runs on the
+        driver's clock, so a run can be timed without waiting for it'''
+        import virtual_smoothie
+        self.simulating = False
+        self._virtual_smoothie = virtual_smoothie.VirtualSmoothie(
+            clock=self.clock)
+        self._connection = self._virtual_smoothie.loopback()
         self._setup()
 
     def disconnect(self):
+        if not self.simulating:
+            self._drain()
         self.simulating = True
+        self._currents = {}
+        if self._virtual_smoothie:
+            self._connection.close()
+            self._virtual_smoothie.stop()
+            self._virtual_smoothie = None
     
     @property
     def position(self):
         return {k.upper(): v for k, v in self._position.items()}
 
+    @property
+    def virtual_smoothie(self):
+        '''The VirtualSmoothie behind the connection, None on a real robot'''
+        return self._virtual_smoothie
+
     @property
     def switch_state(self):
         '''Returns the state of all SmoothieBoard limit switches'''
@@ -113,6 +219,15 @@ class SmoothieDriver_3_0_0:
         speed_per_min = int(self._combined_speed * SEC_PER_MIN)
         command = GCODES['SET_SPEED'] + str(speed_per_min)
         self._send_command(command)
+        self._feed_rate = speed_per_min
+
+    def set_relative(self):
+        self._send_command(GCODES['RELATIVE_COORDS'])
+        self._relative = True
+
+    def set_absolute(self):
+        self._send_command(GCODES['ABSOLUTE_COORDS'])
+        self._relative = False
     
     def enable_motors(self):
         #Enable motors
@@ -122,80 +237,278 @@ class SmoothieDriver_3_0_0:
         #Enable motors
         return self._send_command(GCODES['Disable_Motors'])
     
+    def set_steps_per_mm(self, axes, value):
+        ''' set axes steps per mm'''
+        values = ['{}{}'.format(axis, value) for axis in axes.upper()]
+        self._send_command('{} {}'.format(
+            GCODES['STEPS_PER_MM'], ' '.join(values)))
+
     def set_current(self, axes, value):
-        ''' set total movement speed in mm/second'''
-        values = ['{}{}'.format(axis, value) for axis in axes]
+        ''' set axes current in amps, skipping axes already at that value'''
+        changed = [
+            axis for axis in axes.upper()
+            if self._currents.get(axis) != value
+        ]
+        if not changed:
+            return
+        values = ['{}{}'.format(axis, value) for axis in changed]
         command = '{} {}'.format(
             GCODES['SET_CURRENT'],
             ' '.join(values)
         )
         self._send_command(command)
+        self._currents.update({axis: value for axis in changed})
         self.delay(0.05)
 
+    @contextlib.contextmanager
+    def hold_plunger_current(self, value=PLUNGER_CURRENT_HIGH):
+        '''Keeps the plunger current high for a whole block of moves
+        instead of raising and lowering it around every plunger move'''
+        self.set_current('BC', value)
+        self._plunger_holds += 1
+        try:
+            yield
+        finally:
+            self._plunger_holds -= 1
+            if not self._plunger_holds:
+                if self.pipelined and not self.simulating:
+                    # let the last plunger move finish before dropping
+                    self._queue_command(GCODES['WAIT'])
+                self.set_current('BC', PLUNGER_CURRENT_LOW)
+
+    def barrier(self):
+        '''Blocks until all queued commands are acknowledged and motion has
+        finished. Call before anything that needs the robot to be still,
+        like a scale reading. Does nothing unless pipelined'''
+        if self.pipelined and not self.simulating:
+            self._queue_command(GCODES['WAIT'])
+            self._drain()
+            self._motion_done_at = self.clock.monotonic()
+
+    def wait_for_motion(self, margin=0):
+        '''Sleeps until the predicted end of all sent moves plus margin
+        seconds, instead of a fixed worst case settle time'''
+        remaining = self._motion_done_at + margin - self.clock.monotonic()
+        if remaining > 0:
+            self.clock.sleep(remaining)
+
     # ----------- Private functions --------------- #
 
     def _reset_from_error(self):
+        if not self.simulating:
+            # commands queued after an error or ALARM are answered with
+            # more of them, which must not be taken for the reset's answer
+            while self._in_flight:
+                try:
+                    self._collect_ack()
+                except serial_communication.SmoothieError:
+                    pass
+            serial_communication.clear_buffer(self._connection)
         self._send_command(GCODES['RESET_FROM_ERROR'])
 
     # TODO: Write GPIO low
     def _reboot(self):
         self._setup()
 
-    # Potential place for command optimization (buffering, flushing, etc)
-    def _send_command(self, command, timeout=None):
+    def _send_command(self, command, timeout=None, barrier=False):
         if self.simulating:
             pass
         else:
-            moving_plunger = ('B' in command or 'C' in command) \
+            started_at = self.clock.monotonic()
+            moving_plunger = not self._plunger_holds \
+                and ('B' in command or 'C' in command) \
                 and (GCODES['MOVE'] in command or GCODES['HOME'] in command)
 
             if moving_plunger:
                 self.set_current('BC', PLUNGER_CURRENT_HIGH)
 
-            command_line = command + ' M400'
-            ret_code = serial_communication.write_and_return(
-                command_line, self._connection, timeout)
+            if self.pipelined and not command.startswith(QUERY_GCODES):
+                # Smoothie will not read the next line until an M400 is
+                # done, so plunger moves keep theirs to make sure the low
+                # current is only applied once the plunger has stopped
+                if barrier or moving_plunger:
+                    command = '{} {}'.format(command, GCODES['WAIT'])
+                ret_code = self._queue_command(command, timeout)
+                if barrier:
+                    self._drain()
+                    self._motion_done_at = self.clock.monotonic()
+            else:
+                self._drain()
+                command_line = command + ' M400'
+                ret_code = serial_communication.write_and_return(
+                    command_line, self._connection, timeout)
+                # M400 only acks once everything has stopped
+                self._motion_done_at = self.clock.monotonic()
 
             if moving_plunger:
                 self.set_current('BC', PLUNGER_CURRENT_LOW)
 
+            recorder = serial_communication.latency_recorder
+            if recorder:
+                recorder.record(
+                    command, 'command', self.clock.monotonic() - started_at)
             return ret_code
 
-    def _setup(self):
-        self._reset_from_error()
-        self._send_command(DEFAULT_ACCELERATION)
-        self._send_command(DEFAULT_CURRENT)
-        self._send_command(DEFAULT_MAX_SPEEDS)
-        self._send_command(DEFAULT_STEPS_PER_MM)
-        self._send_command(GCODES['ABSOLUTE_COORDS'])
-    # ----------- END Private functions ----------- #
-
-    # ----------- Public interface ---------------- #
-    def move(self, x=None, y=None, z=None, a=None, b=None, c=None, speed=None):
-        from numpy import isclose
-        target_position = {'X': x, 'Y': y, 'Z': z, 'A': a, 'B': b, 'C': c}
-
+    def _queue_command(self, command, timeout=None):
+        sent_at = serial_communication.write(command, self._connection)
+        self._in_flight.append(
+            (command, serial_communication.count_acks(command), sent_at,
+             timeout))
+        while len(self._in_flight) > self._window:
+            self._collect_ack()
+
+    def _ack_timeout(self, timeout=None):
+        '''timeout (the port timeout if None) plus the predicted motion
+        still to run, since an M400 or a command queued behind moves only
+        acks once they are done'''
+        if timeout is None:
+            timeout = self._connection.timeout
+        return max(self._motion_done_at - self.clock.monotonic(), 0) + timeout
+
+    def _collect_ack(self):
+        command, count, sent_at, timeout = self._in_flight.popleft()
+        try:
+            response = serial_communication.read_acks(
+                self._connection, count, self._ack_timeout(timeout), command,
+                sent_at)
+        except serial_communication.SmoothieAlarm:
+            # Smoothie halted, nothing queued behind the alarm will run
+            self._in_flight.clear()
+            raise
+        if response is None:
+            self._in_flight.clear()
+            raise RuntimeError(
+                'No acknowledgement from Smoothie for "{}"'.format(command))
+        return response
+
+    def _drain(self):
+        while self._in_flight:
+            self._collect_ack()
+
+    def _track_motion(self, duration):
+        # blocking commands return after the motion, only queued ones run on
+        if self.pipelined and not self.simulating:
+            start = max(self.clock.monotonic(), self._motion_done_at)
+            self._motion_done_at = start + duration
+
+    def _plan_move(self, target_position, speed, position, relative,
+                   feed_rate):
+        '''Returns the G0 command for a move from position (None if no axis
+        moves), its absolute target and its predicted duration'''
         #print("speed is ", speed)
         def valid_movement(coords, axis):
             return not (
                 (axis in DISABLED_AXES) or
                 (coords is None) or
-                isclose(coords, self._position[axis])
+                isclose(coords, 0 if relative else position[axis])
             )
 
         coords = [axis + str(coords)
                   for axis, coords in target_position.items()
                   if valid_movement(coords, axis)]
+        if not coords:
+            return None, target_position, 0
+
         #speed is in mm/s
         movement_speed = ''
         if speed:
             movement_speed = 'F'+str(speed * 60)
+            feed_rate = speed * SEC_PER_MIN
+
+        if relative:
+            target_position = {
+                axis: None if value is None else position[axis] + value
+                for axis, value in target_position.items()
+            }
+        duration = self._motion.duration(position, target_position, feed_rate)
+        command = GCODES['MOVE'] + ''.join(coords) + movement_speed
+        return command, target_position, duration
 
-        if coords:
-            command = GCODES['MOVE'] + ''.join(coords) + movement_speed
+    def _setup(self):
+        self._reset_from_error()
+        self._send_command(DEFAULT_ACCELERATION)
+        self._send_command(DEFAULT_CURRENT)
+        self._currents = _parse_current_values(DEFAULT_CURRENT)
+        self._send_command(DEFAULT_MAX_SPEEDS)
+        self._send_command(DEFAULT_STEPS_PER_MM)
+        self.set_absolute()
+    # ----------- END Private functions ----------- #
+
+    # ----------- Public interface ---------------- #
+    def move(self, x=None, y=None, z=None, a=None, b=None, c=None, speed=None):
+        target_position = {'X': x, 'Y': y, 'Z': z, 'A': a, 'B': b, 'C': c}
+        command, target_position, duration = self._plan_move(
+            target_position, speed,
+            self._position, self._relative, self._feed_rate)
+
+        if command:
+            if speed:
+                self._feed_rate = speed * SEC_PER_MIN
             self._send_command(command)
+            self._track_motion(duration)
             self._update_position(target_position)
 
+    def move_many(self, targets, speeds=None):
+        '''Moves through the rows of an N x 6 array of absolute X Y Z A B C
+        targets (NaN leaves an axis where it is) at per-row speeds in mm/s
+        (NaN keeps the current feed rate). No-op axes are filtered and the
+        G-code built for the whole batch in one vectorized pass'''
+        if self._relative:
+            raise RuntimeError('move_many takes absolute coordinates')
+        targets = np.asarray(targets, dtype=float).reshape(
+            -1, len(WAYPOINT_AXES))
+        if speeds is None:
+            speeds = np.nan
+        speeds = np.broadcast_to(
+            np.asarray(speeds, dtype=float), len(targets))
+
+        start = np.array([self._position[axis] for axis in WAYPOINT_AXES])
+        positions = _forward_fill(targets, start)
+        previous = np.vstack([start, positions[:-1]])
+        moving = ~np.isnan(targets) & ~isclose(positions, previous)
+        for axis in DISABLED_AXES:
+            moving[:, WAYPOINT_AXES.index(axis)] = False
+        active = moving.any(axis=1)
+        if not active.any():
+            return
+
+        # rows that are not sent do not change Smoothie's feed rate
+        speeds = np.where(active, speeds, np.nan)
+        feed_rates = _forward_fill(
+            speeds[:, None] * SEC_PER_MIN,
+            [np.nan if self._feed_rate is None else self._feed_rate])[:, 0]
+        durations = self._motion.batch_durations(
+            start, positions, feed_rates, WAYPOINT_AXES)
+
+        commands = [
+            GCODES['MOVE'] + ''.join(
+                axis + str(value)
+                for axis, value, moved in zip(WAYPOINT_AXES, row, row_moving)
+                if moved
+            ) + ('' if np.isnan(speed) else 'F' + str(speed * SEC_PER_MIN))
+            for row, row_moving, speed in zip(
+                targets.tolist(), moving.tolist(), speeds.tolist())
+            if any(row_moving)
+        ]
+
+        duration = float(durations[active].sum())
+        timeout = duration + serial_communication.DEFAULT_SERIAL_TIMEOUT
+        for line in _pack_lines(commands):
+            self._send_command(line, timeout=timeout)
+        self._track_motion(duration)
+        if not np.isnan(feed_rates[-1]):
+            self._feed_rate = float(feed_rates[-1])
+        for row in positions[active].tolist():
+            self._update_position(dict(zip(WAYPOINT_AXES, row)))
+
+    @contextlib.contextmanager
+    def sequence(self):
+        '''Collects the moves made on the yielded MoveSequence and sends
+        them as one line (or a few) when the block exits'''
+        moves = MoveSequence(self)
+        yield moves
+        moves.send()
+
     def home(self, axis=AXES, disabled=DISABLED_AXES):
         axis = axis.upper()
 
@@ -251,6 +564,7 @@ class SmoothieDriver_3_0_0:
             seconds=seconds
         )
         self._send_command(command)
+        self._track_motion(seconds)
 
     def probe_axis(self, axis, probing_distance):
         if axis.upper() in AXES:
@@ -266,4 +580,68 @@ class SmoothieDriver_3_0_0:
     
     
 
-    # ----------- END Public interface ------------ #
\ No newline at end of file
+    # ----------- END Public interface ------------ #
+
+
+class MoveSequence:
+    '''Moves, dwells and G90/G91 switches collected by
+    SmoothieDriver_3_0_0.sequence(), sent as few command lines as
+    possible instead of one blocking round trip each'''
+    def __init__(self, driver):
+        self._driver = driver
+        self._codes = []
+        self._targets = []
+        self._duration = 0
+        # state as it will be once the collected codes have run
+        self._position = driver._position.copy()
+        self._relative = driver._relative
+        self._feed_rate = driver._feed_rate
+
+    def set_relative(self):
+        self._codes.append(GCODES['RELATIVE_COORDS'])
+        self._relative = True
+
+    def set_absolute(self):
+        self._codes.append(GCODES['ABSOLUTE_COORDS'])
+        self._relative = False
+
+    def move(self, x=None, y=None, z=None, a=None, b=None, c=None, speed=None):
+        target_position = {'X': x, 'Y': y, 'Z': z, 'A': a, 'B': b, 'C': c}
+        command, target_position, duration = self._driver._plan_move(
+            target_position, speed,
+            self._position, self._relative, self._feed_rate)
+
+        if command:
+            if speed:
+                self._feed_rate = speed * SEC_PER_MIN
+            self._codes.append(command)
+            self._targets.append(target_position)
+            self._position.update({
+                axis: value
+                for axis, value in target_position.items() if value is not None
+            })
+            self._duration += duration
+
+    def delay(self, seconds):
+        self._codes.append('{code}P{seconds}'.format(
+            code=GCODES['DWELL'],
+            seconds=seconds
+        ))
+        self._duration += seconds
+
+    def lines(self):
+        return _pack_lines(self._codes)
+
+    def send(self):
+        # blocking lines ack only once the whole line has run
+        timeout = self._duration + serial_communication.DEFAULT_SERIAL_TIMEOUT
+        for line in self.lines():
+            self._driver._send_command(line, timeout=timeout)
+        self._driver._relative = self._relative
+        self._driver._feed_rate = self._feed_rate
+        self._driver._track_motion(self._duration)
+        for target_position in self._targets:
+            self._driver._update_position(target_position)
+        self._codes = []
+        self._targets = []
+        self._duration = 0
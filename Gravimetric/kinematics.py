@@ -0,0 +1,84 @@
+"""
+Trapezoidal motion-time model for Smoothie moves.
+
+Each axis accelerates at its M204 rate up to the lower of the feed rate
+and its M203.1 limit, cruises, then decelerates; a move is finished once
+its slowest axis is.
+"""
+import re
+import math
+
+import numpy as np
+
+SEC_PER_MIN = 60
+AXES = 'XYZABC'
+
+PARAM_PATTERN = re.compile(r'([A-Z])(-?\d*\.?\d+)')
+
+
+def parse_axis_settings(command):
+    '''Returns {axis: value} of a settings command like M203.1 X600 B8'''
+    args = command.split(' ', 1)[1] if ' ' in command else ''
+    return {
+        axis: float(value)
+        for axis, value in PARAM_PATTERN.findall(args.upper())
+        if axis in AXES
+    }
+
+
+def move_duration(distance, speed, acceleration):
+    '''Time in seconds to travel distance (mm) at up to speed (mm/s)'''
+    distance = abs(distance)
+    if not distance:
+        return 0
+    if distance < speed ** 2 / acceleration:
+        # triangular profile, never reaches full speed
+        return 2 * math.sqrt(distance / acceleration)
+    return distance / speed + speed / acceleration
+
+
+def move_durations(distances, speeds, accelerations):
+    '''Array version of move_duration, broadcasting its arguments'''
+    distances = np.abs(distances)
+    return np.where(
+        distances < speeds ** 2 / accelerations,
+        2 * np.sqrt(distances / accelerations),
+        distances / speeds + speeds / accelerations)
+
+
+class MotionModel:
+    def __init__(self, max_speeds, acceleration):
+        '''max_speeds in mm/s and acceleration in mm/s^2, keyed by axis'''
+        self.max_speeds = max_speeds
+        self.acceleration = acceleration
+
+    @classmethod
+    def from_gcode(cls, max_speeds_command, acceleration_command):
+        return cls(
+            parse_axis_settings(max_speeds_command),
+            parse_axis_settings(acceleration_command))
+
+    def duration(self, start, target, feed_rate=None):
+        '''Predicted seconds to move from start to target, both
+        {axis: position}. feed_rate is the G0 F value in mm/min'''
+        durations = [0]
+        for axis, value in target.items():
+            if value is None:
+                continue
+            speed = self.max_speeds[axis]
+            if feed_rate:
+                speed = min(speed, feed_rate / SEC_PER_MIN)
+            durations.append(move_duration(
+                value - start[axis], speed, self.acceleration[axis]))
+        return max(durations)
+
+    def batch_durations(self, start, targets, feed_rates, axes=AXES):
+        '''Predicted seconds of each move through the rows of targets
+        (N x len(axes), absolute) starting at start (len(axes)).
+        feed_rates holds mm/min per row, NaN for the axis maximum'''
+        max_speeds = np.array([self.max_speeds[axis] for axis in axes])
+        accelerations = np.array([self.acceleration[axis] for axis in axes])
+        previous = np.vstack([start, targets[:-1]])
+        speeds = np.fmin(max_speeds, feed_rates[:, None] / SEC_PER_MIN)
+        durations = move_durations(targets - previous, speeds, accelerations)
+        return durations.max(axis=1)
@@ -0,0 +1,103 @@
+"""
+Per-command latency histograms for the serial and driver layers.
+
+Timings are bucketed by G-code (the first code on the line) and metric:
+    write       time spent in the serial write call
+    first_byte  from the write until the first response byte was read
+    ack         from the write until all acks were read
+    command     whole SmoothieDriver_3_0_0._send_command call
+Bins are fixed and log spaced, so recording a value is a bisect and a few
+additions regardless of run length.
+"""
+import csv
+import json
+import bisect
+
+import serial_communication
+
+# upper bin edges in seconds, 100 us up to ~100 s in half octaves
+BIN_EDGES = [1e-4 * 2 ** (i / 2) for i in range(41)]
+
+SUMMARY_FIELDS = ['gcode', 'metric', 'count', 'mean', 'min', 'max', 'p50', 'p95']
+
+
+def gcode_key(command):
+    match = serial_communication.GCODE_PATTERN.search(command)
+    return match.group() if match else command.split(' ')[0]
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BIN_EDGES) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.minimum = float('inf')
+        self.maximum = 0.0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(BIN_EDGES, value)] += 1
+        self.count += 1
+        self.total += value
+        self.minimum = min(self.minimum, value)
+        self.maximum = max(self.maximum, value)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, q):
+        '''Upper edge of the bin holding the q-th percentile (0-100)'''
+        target = self.count * q / 100
+        seen = 0
+        for edge, count in zip(BIN_EDGES + [self.maximum], self.counts):
+            seen += count
+            if count and seen >= target:
+                return min(edge, self.maximum)
+        return self.maximum
+
+
+class LatencyRecorder:
+    def __init__(self):
+        self._histograms = {}
+
+    def record(self, command, metric, seconds):
+        key = (gcode_key(command), metric)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = Histogram()
+        histogram.add(seconds)
+
+    def summary(self):
+        return [
+            {
+                'gcode': gcode,
+                'metric': metric,
+                'count': histogram.count,
+                'mean': histogram.mean,
+                'min': histogram.minimum,
+                'max': histogram.maximum,
+                'p50': histogram.percentile(50),
+                'p95': histogram.percentile(95),
+            }
+            for (gcode, metric), histogram in sorted(self._histograms.items())
+        ]
+
+    def to_csv(self, file_name):
+        with open(file_name, 'w', newline='') as f:
+            writer = csv.DictWriter(f, SUMMARY_FIELDS)
+            writer.writeheader()
+            writer.writerows(self.summary())
+
+    def to_json(self, file_name):
+        rows = self.summary()
+        for row in rows:
+            row['bins'] = self._histograms[(row['gcode'], row['metric'])].counts
+        with open(file_name, 'w') as f:
+            json.dump({'bin_edges': BIN_EDGES, 'histograms': rows}, f, indent=2)
+
+    def export(self, file_name):
+        '''Writes JSON for .json file names, CSV otherwise'''
+        if file_name.endswith('.json'):
+            self.to_json(file_name)
+        else:
+            self.to_csv(file_name)
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+"""
+Runs several gravimetric rigs at once, one worker process per robot/scale
+pair, and collects all their results into one CSV.
+
+The rigs and their test plans are listed in a JSON file, args are the
+pip_test options of that rig:
+
+    [
+        {"rig": "rig1", "args": ["-t", "Fixed", "-R", "COM3", "-S", "COM7"]},
+        {"rig": "rig2", "args": ["-t", "Gravi", "-R", "COM4", "-S", "COM8"]}
+    ]
+
+    python orchestrator.py -r rigs.json
+
+Every worker runs pip_test.main in its own process, so each rig has its own
+robot, scale and options globals, and sends every result row back over a
+shared queue. Test plans that prompt for input (prewet) can't be used here.
+"""
+import csv
+import json
+import queue
+import datetime
+import optparse
+import multiprocessing
+import concurrent.futures
+
+import pip_test
+
+RESULT_FIELDS = ['rig', 'Dist_Travel', 'Initial_Weight(g)', 'Final_Weight(g)',
+                 'Delta_Weight(g)', 'Volume(uL)', 'uL/mm', 'time', 'CV',
+                 'average', 'std', 'read_initial_s', 'aspirate_s',
+                 'settle_s', 'read_final_s', 'dispense_s']
+POLL_INTERVAL = 0.5
+
+
+def run_rig(rig, args, results):
+    '''Worker process: runs one rig's test plan, putting (rig, row) on the
+    results queue for every row it records. Returns (rig, error)'''
+    pip_test.result_sink = lambda row: results.put((rig, row))
+    try:
+        pip_test.main(list(args) + ['--rig', rig])
+    except SystemExit as e:
+        # bad options end in parser.error, which only fails this rig
+        if e.code:
+            return rig, repr(e)
+    except Exception as e:
+        return rig, repr(e)
+    return rig, None
+
+
+def collect(results, futures, file_name):
+    '''Writes the rows of all rigs to file_name until every worker is done'''
+    with open(file_name, 'w', newline='') as f:
+        writer = csv.DictWriter(f, RESULT_FIELDS, extrasaction='ignore')
+        writer.writeheader()
+        while True:
+            try:
+                rig, row = results.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                # workers put their rows before returning, so once they are
+                # all done an empty queue means everything was collected
+                if all(future.done() for future in futures):
+                    return
+                continue
+            row['rig'] = rig
+            writer.writerow(row)
+            f.flush()
+            print("%s: %s uL" % (rig, row.get('Volume(uL)')))
+
+
+def run(rigs, file_name):
+    '''Runs every rig of the plan in parallel, returns {rig: error}'''
+    with multiprocessing.Manager() as manager, \
+            concurrent.futures.ProcessPoolExecutor(len(rigs)) as pool:
+        results = manager.Queue()
+        futures = [
+            pool.submit(run_rig, rig['rig'], rig.get('args', []), results)
+            for rig in rigs
+        ]
+        collect(results, futures, file_name)
+        return dict(future.result() for future in futures)
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage='usage: %prog [options] ')
+    parser.add_option("-r", "--rigs", dest = "rigs", type = 'str', default = 'rigs.json', help = "JSON file listing the rigs and their pip_test options")
+    parser.add_option("-f", "--file", dest = "file", type = 'str', default = None, help = "Combined results file, results/All_Rigs_<time>.csv by default")
+    (options, args) = parser.parse_args(args = None, values = None)
+
+    with open(options.rigs) as f:
+        rigs = json.load(f)
+    file_name = options.file or "results/All_Rigs_%s.csv" % (datetime.datetime.now().strftime("%m-%d-%y_%H-%M"))
+    errors = run(rigs, file_name)
+    for rig, error in errors.items():
+        print(rig, "failed:" if error else "done", error or "")
@@ -0,0 +1,142 @@
+"""
+Timeline of the phases of a test run.
+
+Every phase is timed on a clock, the time module or a
+sim_clock.SimulatedClock for dry runs, and kept as a (phase, start, end)
+event, so a run can be summarised per phase or written out whole. Laps
+group the phases of one test cycle for per-cycle timings and profiles:
+
+    timeline = Timeline()
+    timeline.start_lap()
+    with timeline.phase('aspirate'):
+        aspirate_action(...)
+    timings = timeline.lap()        # {'aspirate': 2.1}
+    timeline.print_summary()
+    timeline.print_profile()
+
+"""
+import csv
+import time
+import datetime
+import contextlib
+
+import numpy as np
+
+SUMMARY_FIELDS = ['phase', 'count', 'total', 'mean', 'share']
+PROFILE_FIELDS = ['phase', 'mean', 'p95', 'share']
+# time between phases, like writing results
+OTHER = 'other'
+
+
+def format_duration(seconds):
+    '''H:MM:SS'''
+    return str(datetime.timedelta(seconds=round(seconds)))
+
+
+class Timeline:
+    def __init__(self, clock=time):
+        self.clock = clock
+        self.started_at = clock.monotonic()
+        self.events = []
+        # {phase: seconds} of every lap
+        self.laps = []
+        self._lap_start = 0
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = self.clock.monotonic()
+        try:
+            yield
+        finally:
+            self.events.append((name, start, self.clock.monotonic()))
+
+    def start_lap(self):
+        '''Phases from now on count towards the next lap'''
+        self._lap_start = len(self.events)
+
+    def lap(self):
+        '''Ends the lap, returns and keeps the seconds spent in each of its
+        phases'''
+        timings = {}
+        for name, start, end in self.events[self._lap_start:]:
+            timings[name] = timings.get(name, 0.0) + end - start
+        self.laps.append(timings)
+        self._lap_start = len(self.events)
+        return timings
+
+    @property
+    def elapsed(self):
+        return self.clock.monotonic() - self.started_at
+
+    def summary(self):
+        '''Count, total and mean seconds and share of the run of every
+        phase in order of first use, plus the time outside of phases'''
+        totals = {}
+        for name, start, end in self.events:
+            count, total = totals.get(name, (0, 0.0))
+            totals[name] = (count + 1, total + end - start)
+        elapsed = self.elapsed
+        other = elapsed - sum(total for _, total in totals.values())
+        totals[OTHER] = (1, max(other, 0.0))
+        return [
+            {
+                'phase': name,
+                'count': count,
+                'total': total,
+                'mean': total / count,
+                'share': total / elapsed * 100 if elapsed else 0.0,
+            }
+            for name, (count, total) in totals.items()
+        ]
+
+    def profile(self, since=0):
+        '''Mean and 95th percentile seconds per lap of every phase of the
+        laps from index since on, and its share of the mean lap time'''
+        laps = self.laps[since:]
+        phases = []
+        for timings in laps:
+            phases += [name for name in timings if name not in phases]
+        if not phases:
+            return []
+        # a phase missing from a lap took no time in it
+        seconds = np.array([[timings.get(name, 0.0) for name in phases]
+                            for timings in laps])
+        means = seconds.mean(axis=0)
+        lap_time = means.sum()
+        return [
+            {
+                'phase': name,
+                'mean': float(mean),
+                'p95': float(p95),
+                'share': float(mean / lap_time * 100) if lap_time else 0.0,
+            }
+            for name, mean, p95 in zip(
+                phases, means, np.percentile(seconds, 95, axis=0))
+        ]
+
+    def print_profile(self, since=0):
+        rows = self.profile(since)
+        if not rows:
+            return
+        print("%-14s %8s %8s %6s   (%d cycles)" % ('Phase', 'Mean s', 'p95 s', 'Share', len(self.laps) - since))
+        for row in rows:
+            print("%-14s %8.2f %8.2f %5.1f%%" % (
+                row['phase'], row['mean'], row['p95'], row['share']))
+        print("%-14s %8.2f" % ('Cycle', sum(row['mean'] for row in rows)))
+
+    def print_summary(self):
+        print("%-14s %6s %10s %8s %6s" % ('Phase', 'Count', 'Total', 'Mean s', 'Share'))
+        for row in self.summary():
+            print("%-14s %6d %10s %8.2f %5.1f%%" % (
+                row['phase'], row['count'], format_duration(row['total']),
+                row['mean'], row['share']))
+        print("%-14s %6s %10s" % ('Total', '', format_duration(self.elapsed)))
+
+    def to_csv(self, file_name):
+        '''One row per phase, times in seconds from the start of the run'''
+        with open(file_name, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['phase', 'start', 'end', 'duration'])
+            for name, start, end in self.events:
+                writer.writerow([name, start - self.started_at,
+                                 end - self.started_at, end - start])
@@ -8,161 +8,241 @@ Last updated: 3/19/2018
 """
 
 
-import os, sys
+import os
 import time
+import asyncio
 import datetime
 import optparse
 
 import serial
-import serial_communication as SC
+import serial_communication
 import driver_3_0
+import async_transport
+import latency
+import scale_backend
+import scale_sampler
+import settle_detector
+import running_stats
+import result_store
+import results_catalog
+import calibration
+import pipette_profiles
+import adaptive_sweep
+import sim_clock
+import phase_timeline
 import csv
-import statistics
 
-sys.path.insert(0, os.path.abspath('../Equipment'))
-import Ragwag_Scale_Framework as SC
+#Called with a copy of every row written to the results file, set by the
+#multi-rig orchestrator to collect results from its workers
+result_sink = None
+#time module, or a simulated clock for --dry_run
+clock = time
+#Phases of a test cycle, their seconds are recorded with every cycle
+CYCLE_PHASES = ['read_initial', 'aspirate', 'settle', 'read_final', 'dispense']
+PHASE_FIELDS = [phase + '_s' for phase in CYCLE_PHASES]
+#Test names of options.test
+CONSTANT_TESTS = ['Fixed','fixed', 'fix']
+GRAVIMETRIC_TESTS = ['Gravi', 'gravi', 'Gravimetric', 'gravimetric']
+PREWET_TESTS = ['Prewet','prewet']
+#Seconds the scale settles after motion when --margin is not set, the
+#settle times the test protocols were validated with
+CONSTANT_SETTLE = 3
+GRAVIMETRIC_SETTLE = 2
 
-def uL_per_mm(pipette, volume, uL_mm):
-    p_300 = ['P300', 'p300', 'p300_single']
-    p_10 = ['P10', 'p10', 'p10_single']
-    P300_Multi = ['P300_Multi', 'p300_multi, Multi_p300']
-    P10_Multi = ['P10_Multi', 'p10_multi, Multi_p10']
-    
-    if pipette == p_10:
-        pip_dist = (volume)/uL_mm
-    elif pipette in p_300:
-        pass
-    elif pipette in P300_Multi:
-        pass
-    elif pipette in P10_Multi:
-        pass
-    else:
-        pass
-    return pip_dist
+def uL_per_mm(pipette, volume, uL_mm = None):
+    #Plunger distance for a volume, at a fixed uL_mm if given, otherwise
+    #from the pipette's calibration fitted to its Gravimetric runs
+    if uL_mm:
+        return volume/uL_mm
+    return calibration.load(pipette).distance(volume)
     
 def set_relative(driver):
-    driver._send_command('G91')
+    driver.set_relative()
 
 def set_absolute(driver):
-    driver._send_command('G90')
+    driver.set_absolute()
     
-def pipette_type(pipette):
-    p_300 = ['P300', 'p300', 'p300_single']
-    p_10 = ['P10', 'p10', 'p10_single']
-    P300_Multi = ['P300_Multi', 'p300_multi', 'Multi_p300']
-    P10_Multi = ['P10_Multi', 'p10_multi', 'Multi_p10']
-    P_50  = ['P_50', 'P50', 'P50_Single']
-    #Change these variables based on the setup
-    print(pipette)
-    if pipette in p_300:
-        PIP_BOTTOM = 1
-        BLOWOUT = -1
-        raise_position = 70
-        descend_position = 63
-        pipette_speed = 5
-        dispense_speed = 10
-        A_axis_speed = 50
-        print("P300-Single")
-        return PIP_BOTTOM, BLOWOUT, raise_position, descend_position,pipette_speed, dispense_speed, A_axis_speed
-    elif pipette in P_50:
-        PIP_BOTTOM = 2
-        BLOWOUT = 0
-        raise_position = 85
-        descend_position = 80
-        pipette_speed = 5
-        dispense_speed = 10
-        A_axis_speed = 50
-        return PIP_BOTTOM, BLOWOUT, raise_position, descend_position,pipette_speed, dispense_speed, A_axis_speed
-    elif pipette in P300_Multi:
-        PIP_BOTTOM = 2
-        BLOWOUT = -1
-        raise_position = 100
-        descend_position = 90
-        pipette_speed = 5
-        dispense_speed = 10
-        A_axis_speed = 50
-        return PIP_BOTTOM, BLOWOUT, raise_position, descend_position,pipette_speed, dispense_speed, A_axis_speed
-    elif pipette in p_10:
-        PIP_BOTTOM = 0
-        BLOWOUT = -2
-        raise_position = 68
-        descend_position = 59
-        pipette_speed = 5
-        dispense_speed = 10
-        A_axis_speed = 50
-        print("P10-Single")
-        return PIP_BOTTOM, BLOWOUT, raise_position, descend_position,pipette_speed, dispense_speed, A_axis_speed
-    elif pipette in P10_Multi:
-        PIP_BOTTOM = 1
-        BLOWOUT = -2
-        raise_position = 84
-        descend_position = 72
-        pipette_speed = 5
-        dispense_speed = 10
-        A_axis_speed = 50
-        return PIP_BOTTOM, BLOWOUT, raise_position, descend_position,pipette_speed, dispense_speed, A_axis_speed
-    else:
-        print("Nothing set too")
-        
-def aspirate_action(aspirate_dist, backlash, relative=False):
-    #Setting Variable for Pipettes
-    PIP_BOTTOM, BLOWOUT, raise_position, descend_position,pipette_speed, dispense_speed, A_axis_speed = pipette_type(options.pipette)
-    
-    if relative == True:
-        #robot.home('b')
-        set_absolute(robot)
-        robot.move(c=PIP_BOTTOM)
-        set_relative(robot)
-        robot.move(c=backlash)
-        set_absolute(robot)
+def prepare_plunger(profile, backlash):
+    #Plunger to bottom and take up backlash, done above the liquid
+    with robot.hold_plunger_current(profile.plunger_current), robot.sequence() as moves:
+        set_absolute(moves)
+        moves.move(c=profile.bottom)
+        set_relative(moves)
+        moves.move(c=backlash)
+        set_absolute(moves)
 
-        robot.move( a = descend_position, speed = A_axis_speed) #enter liquid
-        set_relative(robot)
-        robot.move( c = aspirate_dist, speed = pipette_speed)
-        time.sleep(0.5)
-        set_absolute(robot)
+def aspirate_action(profile, aspirate_dist, backlash, relative=False, prepared=False):
+    with robot.hold_plunger_current(profile.plunger_current):
+        if relative == True:
+            #robot.home('b')
+            if not prepared:
+                prepare_plunger(profile, backlash)
+
+            with robot.sequence() as moves:
+                moves.move( a = profile.descend_position, speed = profile.a_axis_speed) #enter liquid
+                set_relative(moves)
+                moves.move( c = aspirate_dist, speed = profile.pipette_speed)
+                moves.delay(0.5)
+                set_absolute(moves)
 
-        robot.move( a = raise_position, speed = A_axis_speed) #exit liquid
+                moves.move( a = profile.raise_position, speed = profile.a_axis_speed) #exit liquid
         
-    else:
-        robot.move( c = PIP_BOTTOM)
-        robot.move( c = backlash)
-        robot.move( a = descend_position, speed = A_axis_speed) #enter liquid
-        robot.move( c = aspirate_dist, speed = pipette_speed)
-        robot.move( a = raise_position, speed = A_axis_speed) #exit liquid
+        else:
+            with robot.sequence() as moves:
+                moves.move( c = profile.bottom)
+                moves.move( c = backlash)
+                moves.move( a = profile.descend_position, speed = profile.a_axis_speed) #enter liquid
+                moves.move( c = aspirate_dist, speed = profile.pipette_speed)
+                moves.move( a = profile.raise_position, speed = profile.a_axis_speed) #exit liquid
         
     
-def dispense_action(backlash, disp_dist, relative=False):
-
-    PIP_BOTTOM, BLOWOUT, raise_position, descend_position,pipette_speed, dispense_speed, A_axis_speed = pipette_type(options.pipette)
-    
-    if relative == True:
-        relative_movement = -1 * (disp_dist)
-        set_relative(robot)
-        robot.move(c = relative_movement, speed = dispense_speed)
-        set_absolute(robot)
+def dispense_action(profile, backlash, disp_dist, relative=False):
+    with robot.hold_plunger_current(profile.plunger_current), robot.sequence() as moves:
+        if relative == True:
+            relative_movement = -1 * (disp_dist)
+            set_relative(moves)
+            moves.move(c = relative_movement, speed = profile.dispense_speed)
+            set_absolute(moves)
     
-    else:
-        robot.move( a = descend_position+2, speed = A_axis_speed) #enter liquid
-        robot.move( c = PIP_BOTTOM, speed = dispense_speed)
-        robot.move( c = BLOWOUT, speed = 20)
-        robot.move( a = raise_position, speed = A_axis_speed) #exit liquid  
-        #robot.move( c = BLOWOUT, speed = dispense_speed)
-        #robot.move(a = descend_position, speed = A_axis_speed)
-        #robot.move(a = raise_position, speed = A_axis_speed)
+        else:
+            moves.move( a = profile.descend_position+2, speed = profile.a_axis_speed) #enter liquid
+            moves.move( c = profile.bottom, speed = profile.dispense_speed)
+            moves.move( c = profile.blowout, speed = 20)
+            moves.move( a = profile.raise_position, speed = profile.a_axis_speed) #exit liquid  
+            #robot.move( c = BLOWOUT, speed = dispense_speed)
+            #robot.move(a = descend_position, speed = A_axis_speed)
+            #robot.move(a = raise_position, speed = A_axis_speed)
        
         
 def connect():
     robot.connect()
 
-def setup_pipette(pipette):
+def attach_simulated_scale(profile, scale):
+    #Aspirating below the liquid surface takes liquid off the simulated scale
+    if robot.virtual_smoothie is None:
+        print("No virtual robot, the simulated scale will not change")
+        return
+    scale.attach(robot.virtual_smoothie, options.sim_ul_mm, profile.descend_position + 1)
+
+def settle_margin():
+    #--margin, or the validated settle time of the test
+    if options.margin is not None:
+        return options.margin
+    if options.test in CONSTANT_TESTS:
+        return CONSTANT_SETTLE
+    return GRAVIMETRIC_SETTLE
+
+def settle():
+    #Wait for the end of the last moves, acknowledged when pipelined, plus
+    #the settle margin, or with --adaptive until the scale reading is stable
+    if not options.adaptive:
+        robot.barrier()
+        robot.wait_for_motion(settle_margin())
+        return True
+    robot.wait_for_motion()
+    robot.barrier()
+    if options.dry_run:
+        #No sampler on the simulated clock, wait as long as the simulated pan
+        #takes to settle within --stable_std plus one detector window
+        settle_time = min(GB_Scale.settled_at(options.stable_std) - clock.monotonic() + detector.window, detector.timeout)
+        clock.sleep(settle_time)
+        stable = settle_time < detector.timeout
+    else:
+        mass, settle_time, stable = detector.wait(GB_Scale)
+    print("Settle time: ", round(settle_time, 2), "" if stable else "(not stable, timed out)")
+    return stable
+
+def read_initial(profile, backlash):
+    #Take the initial reading, overlapped with the plunger reset if enabled
+    settle()
+    if not options.overlap:
+        return GB_Scale.read_mass(), False
+    async def read_and_prepare():
+        mass, _ = await asyncio.gather(
+            async_scale.read_mass(),
+            async_robot.run(prepare_plunger, profile, backlash))
+        return mass
+    return asyncio.run(read_and_prepare()), True
+
+def run_cycle(profile, distance, backlash):
+    #One aspirate, weigh and dispense cycle. Returns the initial and final
+    #readings, its phase timings are timeline.lap()
+    timeline.start_lap()
+    #Take Initial Reading
+    with timeline.phase('read_initial'):
+        initial, prepared = read_initial(profile, backlash)
+    #aspirate
+    with timeline.phase('aspirate'):
+        aspirate_action(profile, distance, backlash=backlash, relative=True, prepared=prepared)
+    with timeline.phase('settle'):
+        settle()
+    #take final reading
+    with timeline.phase('read_final'):
+        final = GB_Scale.read_mass()
+    #input('press enter to dispense')
+    #dispense
+    with timeline.phase('dispense'):
+        dispense_action(profile, disp_dist = distance + 1, backlash=backlash, relative=False)
+        robot.barrier()
+    return initial, final
 
-    PIP_BOTTOM, BLOWOUT, raise_position, descend_position,pipette_speed, dispense_speed, A_axis_speed = pipette_type(pipette)
-    robot._reset_from_error()
-    robot.home('AC')
-    robot.move( c = PIP_BOTTOM)
+def setup_pipette(profile):
+    with timeline.phase('setup'):
+        robot._reset_from_error()
+        robot.set_steps_per_mm('C', profile.steps_per_mm)
+        robot.home('AC')
+        robot.move( c = profile.bottom)
 
-def record_data(dist, i_mass, f_mass, log_file, test_data, test):
+def result_file_name(kind, profile = None, extension = ".csv"):
+    #results/<kind>_[<rig>_][<pipette>_]<time>[_<n>], parsed by results_catalog
+    #<n> counts up from 2 while the name is taken, so experiments started
+    #in the same second get files of their own
+    rig = options.rig + "_" if options.rig else ""
+    pipette = results_catalog.file_pipette(profile.name) + "_" if profile else ""
+    name = "results/%s_%s%s%s" % (kind, rig, pipette, datetime.datetime.now().strftime(results_catalog.STAMP_FORMAT))
+    file_name = name + extension
+    number = 1
+    while os.path.exists(file_name):
+        number += 1
+        file_name = "%s_%d%s" % (name, number, extension)
+    return file_name
+
+def open_log(profile, test_data, resume = None):
+    #Returns the results file and its writer, a CSV file or with
+    #--store binary the columnar result store. When resuming from a
+    #checkpoint its file is reopened and cut back to the checkpointed rows
+    #Dry run results are kept out of the results catalog and calibrations
+    kind = "Dry_Run_Data" if options.dry_run else "Pipette_Data"
+    if options.store == 'binary':
+        store = result_store.ResultStore(resume['file'] if resume else result_file_name(kind, profile, ".cols"))
+        if resume:
+            store.truncate(resume['position'])
+        return store, store
+    if resume:
+        f = open(resume['file'], 'a', newline='')
+        f.truncate(resume['position'])
+        return f, csv.DictWriter(f, test_data)
+    #'x', a results file is never written over
+    f = open(result_file_name(kind, profile), 'x', newline='')
+    log_file = csv.DictWriter(f, test_data)
+    log_file.writeheader()
+    return f, log_file
+
+def save_checkpoint(checkpoint, f, **state):
+    #Syncs the results written so far and records where to resume from
+    if checkpoint is None:
+        return
+    f.flush()
+    if not isinstance(f, result_store.ResultStore):
+        os.fsync(f.fileno())
+    checkpoint.save(dict(state, file = f.name, position = f.tell()))
+
+def write_result(log_file, test_data):
+    log_file.writerow(test_data)
+    if result_sink:
+        result_sink(dict(test_data))
+
+def record_data(dist, i_mass, f_mass, log_file, test_data, test, timings = None):
     delta = i_mass - f_mass
     volume = delta*1000 #uL
     
@@ -171,7 +251,10 @@ def record_data(dist, i_mass, f_mass, log_file, test_data, test):
     test_data['Final_Weight(g)'] = f_mass
     test_data['Delta_Weight(g)'] = delta
     test_data['Volume(uL)'] = volume
-    test_data['time'] = time.strftime("%H:%M:%S", time.localtime())
+    test_data['time'] = time.strftime("%H:%M:%S", time.localtime(clock.time()))
+    if timings is not None:
+        for phase, field in zip(CYCLE_PHASES, PHASE_FIELDS):
+            test_data[field] = timings.get(phase)
     
     if test == 1:
         test_data['uL/mm'] = volume/dist
@@ -180,121 +263,158 @@ def record_data(dist, i_mass, f_mass, log_file, test_data, test):
         test_data['average'] = None
         test_data['std'] = None
         
-    log_file.writerow(test_data)
+    write_result(log_file, test_data)
     print("Distance: ", dist)
     print("Volume: ", volume)
     
     #'Dist_Travel': None, 'Inital_Weight(g)':None,'Final_Weight(g)':None, 'Delta_Weight(g)':None, 
     #'Volume(uL)':None, 'time':None, 'CV':None, 'average':None, 'std':None
-def prewet(pipette):
-    setup_pipette(options.pipette)
+def prewet(profile):
+    setup_pipette(profile)
     max_dist = 16
-    PIP_BOTTOM, BLOWOUT, raise_position, descend_position,pipette_speed, dispense_speed, A_axis_speed = pipette_type(options.pipette)
-    print(PIP_BOTTOM)
+    print(profile.bottom)
     #descend_position = 50
+    waypoint = driver_3_0.waypoint
     for prewet in range(1):
         set_absolute(robot)
         #Move Pip Motor Bottom Position
-        robot.move(c = PIP_BOTTOM)
-        #Descend Z Position
-        input('Press enter after changing tip')
-        robot.move(a = descend_position, speed = A_axis_speed)
-        #Aspirate Volume
-        robot.move(c = max_dist, speed = pipette_speed)
-        #Raise Z Position
-        robot.move(a = raise_position, speed = A_axis_speed)
-        #Descend Z Position
-        robot.move(a = descend_position+2, speed = A_axis_speed)
-        #Despense
-        robot.move(c = PIP_BOTTOM, speed = dispense_speed)
-        #Blowout
-        robot.move(c = BLOWOUT, speed = dispense_speed)
-        #Raise Z Position
-        robot.move(a = raise_position, speed = A_axis_speed)
+        robot.move(c = profile.bottom)
+        if options.dry_run:
+            print('Dry run, not waiting for the tip change')
+        else:
+            input('Press enter after changing tip')
+        with timeline.phase('prewet'):
+            robot.move_many([
+                waypoint(a = profile.descend_position),     #Descend Z Position
+                waypoint(c = max_dist),                     #Aspirate Volume
+                waypoint(a = profile.raise_position),       #Raise Z Position
+                waypoint(a = profile.descend_position+2),   #Descend Z Position
+                waypoint(c = profile.bottom),               #Despense
+                waypoint(c = profile.blowout),              #Blowout
+                waypoint(a = profile.raise_position)],      #Raise Z Position
+                speeds = [profile.a_axis_speed, profile.pipette_speed, profile.a_axis_speed, profile.a_axis_speed,
+                          profile.dispense_speed, profile.dispense_speed, profile.a_axis_speed])
+            robot.wait_for_motion()
+            robot.barrier()
  
 
 #Aspirate by increments
-def Gravimetric(max_distance, backlash = 0.5, blowout_backlash = 0, aspirate_dist = 1, offset = 0):
+def Gravimetric(profile, max_distance, backlash = 0.5, blowout_backlash = 0, aspirate_dist = 1, offset = 0, checkpoint = None):
     #Home Pipette Axis and Z Axis
-    setup_pipette(options.pipette)
+    setup_pipette(profile)
     test_type = 1
     #Create a Name for CSV File
-    file_name = "results/Pipette_Data_%s.csv" % (datetime.datetime.now().strftime("%m-%d-%y_%H-%M"))
+    test_data = {'Dist_Travel': None, 'Initial_Weight(g)':None,'Final_Weight(g)':None, 'Delta_Weight(g)':None, 'Volume(uL)':None, 'uL/mm':None, 'time':None}
+    test_data.update(dict.fromkeys(PHASE_FIELDS))
+    resume = checkpoint.state if checkpoint else None
     #Open file and create Headers
-    with open(file_name, 'w', newline='') as f:
-        test_data = {'Dist_Travel': None, 'Initial_Weight(g)':None,'Final_Weight(g)':None, 'Delta_Weight(g)':None, 'Volume(uL)':None, 'uL/mm':None, 'time':None}
-        log_file = csv.DictWriter(f, test_data)
-        log_file.writeheader()
+    f, log_file = open_log(profile, test_data, resume)
+    with f:
         #Number of cycles to Run Formula
         cycles = int(max_distance/aspirate_dist)
         #Increment Value
         current_aspirate_dist = aspirate_dist + offset
+        first_cycle = 0
+        if resume:
+            #Setup homed the plunger again, so the resumed cycle is redone
+            #as a tip conditioning cycle like cycle 0
+            current_aspirate_dist = resume['distance']
+            first_cycle = resume['cycle']
         #Series of moves
-        for cycle in range(cycles+1):
+        for cycle in range(first_cycle, cycles+1):
+            warmup = cycle == first_cycle
             print('current distance = ', current_aspirate_dist)
-            #Pause for 2 Seconds
-            time.sleep(2)
-            #Take Initial Reading
-            initial = GB_Scale.read_mass()
-            time.sleep(2)
-            #aspirate
-            aspirate_action(current_aspirate_dist, backlash=backlash, relative=True)
-            time.sleep(2)
-            #take final reading
-            final = GB_Scale.read_mass()
-            #dispense
-            dispense_action(disp_dist=current_aspirate_dist + 1, backlash=backlash, relative = False)
+            initial, final = run_cycle(profile, current_aspirate_dist, backlash)
             #record and calculate values
-            if cycle => 1:
-                record_data(current_aspirate_dist, initial, final, log_file, test_data, 1)    
+            if not warmup:
+                record_data(current_aspirate_dist, initial, final, log_file, test_data, 1, timeline.lap())
                 #Increment aspirate dist        
                 current_aspirate_dist += aspirate_dist
             else:
                 pass
+            save_checkpoint(checkpoint, f, cycle = cycle, distance = current_aspirate_dist)
         
+#Aspirate at the distances picked by an adaptive sweep
+def adaptive_gravimetric(profile, max_distance, backlash = 0.5, checkpoint = None):
+    setup_pipette(profile)
+    test_data = {'Dist_Travel': None, 'Initial_Weight(g)':None,'Final_Weight(g)':None, 'Delta_Weight(g)':None, 'Volume(uL)':None, 'uL/mm':None, 'time':None}
+    test_data.update(dict.fromkeys(PHASE_FIELDS))
+    resume = checkpoint.state if checkpoint else None
+    f, log_file = open_log(profile, test_data, resume)
+    with f:
+        #Never measure more points than the fixed grid sweep would
+        max_points = int(max_distance/options.aspir_incre)
+        if options.sweep_max:
+            max_points = min(options.sweep_max, max_points)
+        sweep = adaptive_sweep.AdaptiveSweep(max_distance, tolerance = options.sweep_tolerance, initial_points = options.sweep_points, min_step = options.min_step, max_points = max_points)
+        cycle = 0
+        if resume:
+            for distance, volume in resume['points']:
+                sweep.add(distance, volume)
+            cycle = resume['cycle']
+        distance = sweep.next_distance()
+        #Tip conditioning cycle, not recorded
+        run_cycle(profile, distance or max_distance, backlash)
+        while distance is not None:
+            cycle += 1
+            print('current distance = ', distance)
+            initial, final = run_cycle(profile, distance, backlash)
+            record_data(distance, initial, final, log_file, test_data, 1, timeline.lap())
+            sweep.add(distance, (initial-final)*1000)
+            save_checkpoint(checkpoint, f, cycle = cycle, points = sweep.points)
+            distance = sweep.next_distance()
+        print("Sweep done after %d cycles, worst residual %.3f uL" % (cycle, sweep.worst_residual))
+
 #Aspirate with constant Volumes
-def const_vol(cycles, backlash=0.5, blowout_backlash=0, aspirate_dist=10):
-    setup_pipette(options.pipette)
+def const_vol(profile, cycles, backlash=0.5, blowout_backlash=0, aspirate_dist=10, checkpoint=None):
+    setup_pipette(profile)
     test_type = 0
-    file_name = "results/Pipette_Data_%s.csv" % (datetime.datetime.now().strftime("%m-%d-%y_%H-%M"))
-    with open(file_name, 'w', newline='') as f:
-        test_data = { 'Dist_Travel': None, 'Initial_Weight(g)':None,'Final_Weight(g)':None, 'Delta_Weight(g)':None, 'Volume(uL)':None, 'time':None, 'CV':None, 'average':None, 'std':None}
-        log_file = csv.DictWriter(f, test_data)
-        log_file.writeheader()
+    test_data = { 'Dist_Travel': None, 'Initial_Weight(g)':None,'Final_Weight(g)':None, 'Delta_Weight(g)':None, 'Volume(uL)':None, 'time':None, 'CV':None, 'average':None, 'std':None}
+    test_data.update(dict.fromkeys(PHASE_FIELDS))
+    resume = checkpoint.state if checkpoint else None
+    f, log_file = open_log(profile, test_data, resume)
+    with f:
         #aspirate_increment = aspirate_dist / cycles #0.1
         #current_aspirate_dist = aspirate_increment #+ 0.63
         current_aspirate_dist = aspirate_dist
-        list_sum = []
-        for cycle in range(cycles+1):
+        stats = running_stats.RunningStats()
+        first_cycle = 0
+        if resume:
+            #Redo the resumed cycle as a tip conditioning cycle like cycle 0
+            stats = running_stats.RunningStats.from_state(resume['stats'])
+            first_cycle = resume['cycle']
+        for cycle in range(first_cycle, cycles+1):
+            warmup = cycle == first_cycle
             print('current distance = ', current_aspirate_dist)
-            time.sleep(3)
-            initial = GB_Scale.read_mass()
-            time.sleep(2)
-            aspirate_action(current_aspirate_dist, backlash=backlash, relative=True)
-            time.sleep(3)
-            final = GB_Scale.read_mass()
-            #input('press enter to dispense')
-            dispense_action(disp_dist = current_aspirate_dist + 1, backlash=backlash, relative=False)
-            if cycle => 1:
-                record_data(current_aspirate_dist, initial, final, log_file, test_data, 0)
-                volume = (final-initial)*1000
-                list_sum.append(volume)
-            else:
-                pass
-            
-        list_sum.pop(0)
-        print(list_sum)
-        average = abs(sum(list_sum)/len(list_sum))
-        std = statistics.stdev(list_sum)
-        CV = (std/average)*100
+            initial, final = run_cycle(profile, current_aspirate_dist, backlash)
+            if not warmup:
+                record_data(current_aspirate_dist, initial, final, log_file, test_data, 0, timeline.lap())
+            #The first recorded cycle is left out of the statistics
+            if cycle >= 2 and not warmup:
+                stats.add((final-initial)*1000)
+                low, high = stats.cv_interval()
+                print("Mean: %.3f uL  CV: %.3f%%  (95%% CI %.3f - %.3f%%)" % (abs(stats.mean), stats.cv, low, high))
+                decision = running_stats.sequential_decision(stats, precision = options.cv_precision, cv_spec = options.cv_spec, min_count = options.min_cycles)
+                if decision == running_stats.PRECISE:
+                    print("CV known to +-%s%%, stopping after %d cycles" % (options.cv_precision, cycle))
+                    break
+                elif decision == running_stats.FAILED:
+                    print("CV above the %s%% spec, stopping after %d cycles" % (options.cv_spec, cycle))
+                    break
+            save_checkpoint(checkpoint, f, cycle = cycle, stats = stats.state())
+
+        average = abs(stats.mean)
+        std = stats.std
+        CV = stats.cv
         test_data['average'] = average
         test_data['std'] = std
         test_data['CV'] = CV
-        log_file.writerow(test_data)
+        test_data.update(dict.fromkeys(PHASE_FIELDS))
+        write_result(log_file, test_data)
         print("CV:",CV)
             #current_aspirate_dist += aspirate_increment
         
-if __name__ == '__main__':
+def build_parser():
     #options to pick from
     parser = optparse.OptionParser(usage='usage: %prog [options] ')
     parser.add_option("-s", "--speed", dest = "speed", type = 'int', default = 30, help = "Speed Value")
@@ -302,37 +422,137 @@ if __name__ == '__main__':
     parser.add_option("-S", "--scale_port", dest = "scale_port", type = 'str', default = 'COM7', help = "Scale COM Port")
     parser.add_option("-t", "--test", dest = "test", default = "Fixed", type = 'str', help = "Test Type, Gravi or Fixed")
     parser.add_option("-m", "--max", dest = "max_dist", default = 17.4, type = 'float', help = 'max distance to travel for Gravi(ONLY FOR GRAVI)')
-    parser.add_option("-a", "--aspir_incre", dest = "aspir_incre", default = 1, help = 'Gravimetric Increment step 1mm = default(ONLY FOR GRAVI)')
+    parser.add_option("-a", "--aspir_incre", dest = "aspir_incre", default = 1, type = 'float', help = 'Gravimetric Increment step 1mm = default(ONLY FOR GRAVI)')
     parser.add_option("-d", "--dist", dest = "dist", default = 13, type = 'float', help = 'Distance to travel for fixed(ONLY FOR FIXED)')
     parser.add_option("-p", "--p", dest = "pipette", default = 'P50', type = 'str', help = 'Pipette Type as string')
     parser.add_option("-v", "--v", dest = "volume", default = 10.3, type = 'float', help = 'volume for pipette')
-    (options, args) = parser.parse_args(args = None, values = None)
+    parser.add_option("-M", "--margin", dest = "margin", default = None, type = 'float', help = 'Seconds to let the scale settle after the predicted end of motion, %s s for Fixed and %s s for Gravi by default. Only shorten it once -A runs show the scale settles within it' % (CONSTANT_SETTLE, GRAVIMETRIC_SETTLE))
+    parser.add_option("-L", "--latency", dest = "latency", default = None, type = 'str', help = 'Record per-command latency and write it to this .csv or .json file')
+    parser.add_option("-b", "--sampler", dest = "sampler", action = 'store_true', default = False, help = 'Sample the scale continuously in the background and save the mass trace')
+    parser.add_option("-A", "--adaptive", dest = "adaptive", action = 'store_true', default = False, help = 'Read the scale as soon as it is stable instead of after a fixed margin (implies --sampler)')
+    parser.add_option("--settle_timeout", dest = "settle_timeout", default = settle_detector.DEFAULT_TIMEOUT, type = 'float', help = 'Longest adaptive settle wait in seconds')
+    parser.add_option("--stable_std", dest = "stable_std", default = settle_detector.DEFAULT_MAX_STD, type = 'float', help = 'Largest standard deviation (g) of a stable reading')
+    parser.add_option("--stable_slope", dest = "stable_slope", default = settle_detector.DEFAULT_MAX_SLOPE, type = 'float', help = 'Largest drift (g/s) of a stable reading')
+    parser.add_option("-o", "--overlap", dest = "overlap", action = 'store_true', default = False, help = 'Reset the plunger while taking the initial scale reading')
+    parser.add_option("-P", "--pipelined", dest = "pipelined", action = 'store_true', default = False, help = 'Pipeline robot commands, only waiting for motion before scale readings')
+    parser.add_option("--scale", dest = "scale", default = 'ragwag', type = 'choice', choices = ['ragwag', 'sim'], help = 'Scale backend, ragwag or sim (simulated, follows the virtual robot)')
+    parser.add_option("--sim_ul_mm", dest = "sim_ul_mm", default = 3.0, type = 'float', help = 'uL drawn per mm of plunger travel (ONLY FOR SIM)')
+    parser.add_option("--sim_latency", dest = "sim_latency", default = scale_backend.DEFAULT_LATENCY, type = 'float', help = 'Seconds per reading (ONLY FOR SIM)')
+    parser.add_option("--sim_noise", dest = "sim_noise", default = scale_backend.DEFAULT_NOISE, type = 'float', help = 'Reading noise standard deviation in g (ONLY FOR SIM)')
+    parser.add_option("--sim_evaporation", dest = "sim_evaporation", default = 0, type = 'float', help = 'Evaporation loss in g/s (ONLY FOR SIM)')
+    parser.add_option("--sim_seed", dest = "sim_seed", default = None, type = 'int', help = 'Random seed of the reading noise (ONLY FOR SIM)')
+    parser.add_option("-R", "--robot_port", dest = "robot_port", type = 'str', default = None, help = "Robot serial port, found by device name if not set")
+    parser.add_option("--cv_precision", dest = "cv_precision", default = None, type = 'float', help = 'Stop a Fixed run once the CV confidence interval is within +- this many % points')
+    parser.add_option("--cv_spec", dest = "cv_spec", default = None, type = 'float', help = 'Stop a Fixed run once the CV is clearly above this spec in %')
+    parser.add_option("--min_cycles", dest = "min_cycles", default = running_stats.MIN_COUNT, type = 'int', help = 'Cycles to run before stopping early with --cv_precision or --cv_spec')
+    parser.add_option("--calibrated", dest = "calibrated", action = 'store_true', default = False, help = 'Aspirate --v uL using the calibration from past Gravi runs instead of --dist (ONLY FOR FIXED)')
+    parser.add_option("--sweep", dest = "sweep", default = 'grid', type = 'choice', choices = ['grid', 'adaptive'], help = 'Gravi distances, a fixed grid of --aspir_incre steps or adaptive (ONLY FOR GRAVI)')
+    parser.add_option("--sweep_tolerance", dest = "sweep_tolerance", default = adaptive_sweep.DEFAULT_TOLERANCE, type = 'float', help = 'Adaptive sweep stops once the uL/mm model predicts every point within this many uL')
+    parser.add_option("--sweep_points", dest = "sweep_points", default = adaptive_sweep.DEFAULT_INITIAL_POINTS, type = 'int', help = 'Evenly spaced distances an adaptive sweep starts with')
+    parser.add_option("--min_step", dest = "min_step", default = adaptive_sweep.DEFAULT_MIN_STEP, type = 'float', help = 'Smallest distance step of an adaptive sweep in mm')
+    parser.add_option("--sweep_max", dest = "sweep_max", default = None, type = 'int', help = 'Most distances an adaptive sweep measures, at most as many as the --aspir_incre grid')
+    parser.add_option("--store", dest = "store", default = 'csv', type = 'choice', choices = ['csv', 'binary'], help = 'Result file format, csv or binary (columnar, convert with result_store.py)')
+    parser.add_option("-n", "--dry_run", dest = "dry_run", action = 'store_true', default = False, help = 'Run the whole test against a virtual robot and simulated scale on a simulated clock and print the runtime estimate')
+    parser.add_option("--rig", dest = "rig", type = 'str', default = '', help = "Rig name, added to the result file names")
+    return parser
+
+def start():
+    #Creates the scale and robot set up by options and connects the robot.
+    #Returns the scale backend, GB_Scale may be a sampler around it
+    global GB_Scale, detector, robot, async_robot, async_scale, clock, timeline
     #print(options.scale_port)
     #GB_Scale = SC.Scale(port = options.scale_port)
-    GB_Scale = SC.Ragwag_Scale(options.scale_port)
+    clock = time
+    if options.dry_run:
+        clock = sim_clock.SimulatedClock()
+        options.scale = 'sim'
+    timeline = phase_timeline.Timeline(clock)
+    if options.scale == 'sim':
+        scale = scale_backend.SimulatedScale(latency = options.sim_latency, noise = options.sim_noise, evaporation = options.sim_evaporation, seed = options.sim_seed, clock = clock)
+    else:
+        scale = scale_backend.RagwagScale(options.scale_port)
+    GB_Scale = scale
+    if options.adaptive:
+        options.sampler = True
+        detector = settle_detector.SettleDetector(max_slope = options.stable_slope, max_std = options.stable_std, timeout = options.settle_timeout)
+    if options.dry_run:
+        #Threads do not run on the simulated clock, the scale is read directly
+        #and the initial reading is not overlapped with the plunger reset
+        options.sampler = False
+        options.overlap = False
+    if options.sampler:
+        GB_Scale = scale_sampler.ScaleSampler(GB_Scale).start()
     #Create a variable to read Scale Readings
     reading = GB_Scale.read_mass()
     
-    robot = driver_3_0.SmoothieDriver_3_0_0()
-    
+    if options.latency:
+        serial_communication.latency_recorder = latency.LatencyRecorder()
+    robot = driver_3_0.SmoothieDriver_3_0_0(pipelined = options.pipelined, clock = clock)
+    async_robot = async_transport.AsyncSmoothie(robot)
+    async_scale = async_transport.AsyncScale(GB_Scale)
+    if options.dry_run:
+        robot.connect_dry_run()
+    else:
+        robot.connect(port = options.robot_port)
+    return scale
+
+def run_test(profile, scale, checkpoint = None):
+    #Runs options.test with the pipette of profile, resuming from checkpoint
+    if options.scale == 'sim':
+        attach_simulated_scale(profile, scale)
+    distance = options.dist
+    if options.calibrated:
+        distance = uL_per_mm(profile.name, options.volume)
+        print("%s uL = %.3f mm" % (options.volume, distance))
+    print("Start test")
+    first_lap = len(timeline.laps)
+    if options.test in CONSTANT_TESTS:
+        const_vol(profile, options.cycles, backlash = 0.5, aspirate_dist = distance, checkpoint = checkpoint)
+    elif options.test in GRAVIMETRIC_TESTS and options.sweep == 'adaptive':
+        adaptive_gravimetric(profile, options.max_dist, backlash = 0.5, checkpoint = checkpoint)
+    elif options.test in GRAVIMETRIC_TESTS:
+        Gravimetric(profile, options.max_dist, backlash= 0.5, blowout_backlash=0, aspirate_dist = options.aspir_incre, checkpoint = checkpoint)
+    elif options.test in PREWET_TESTS:
+        prewet(profile)
+    else: 
+        print("No String Passed", options.test)
+    timeline.print_profile(first_lap)
+
+def finish(profile = None):
+    print("Test done")
+    robot.disable_motors()
+    if options.latency:
+        serial_communication.latency_recorder.export(options.latency)
+    if options.sampler:
+        GB_Scale.stop()
+        GB_Scale.to_csv(result_file_name("Mass_Trace", profile))
+    if options.dry_run:
+        print("Dry run, estimated runtime", phase_timeline.format_duration(timeline.elapsed))
+        timeline.print_summary()
+        timeline.to_csv(result_file_name("Dry_Run_Timeline", profile))
+        write_command_trace(result_file_name("Dry_Run_Commands", profile))
+
+def write_command_trace(file_name):
+    #Every command line of a dry run, at its simulated time from the start
+    with open(file_name, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['time', 'command'])
+        for at, line in robot._connection.trace:
+            writer.writerow([round(at - timeline.started_at, 3), line])
+
+def main(argv = None):
+    #Runs one rig, the module globals hold its robot, scale and options
+    global options
+    parser = build_parser()
+    (options, args) = parser.parse_args(args = argv, values = None)
+    #Resolve the pipette once, everything after gets the profile
     try:
-        #Fixed Volume
-        constant = ['Fixed','fixed', 'fix']
-        #Incremental Test
-        gravimetric = ['Gravi', 'gravi', 'Gravimetric', 'gravimetric']
-        pip_prewet = ['Prewet','prewet']
-        robot.connect()
-        #distance = uL_per_mm(options.pipette, options.volume)
-        print("Start test")
-        if options.test in constant:
-            const_vol(options.cycles, backlash = 0.5, aspirate_dist = options.dist)
-        elif options.test in gravimetric:
-            Gravimetric(options.max_dist, backlash= 0.5, blowout_backlash=0, aspirate_dist = options.aspir_incre)
-        elif options.test in pip_prewet:
-            prewet(options.pipette)
-        else: 
-            print("No String Passed", options.test)
-        
+        profile = pipette_profiles.get_profile(options.pipette)
+    except KeyError as e:
+        parser.error(e.args[0])
+    scale = start()
+    try:
+        run_test(profile, scale)
     except KeyboardInterrupt:
         robot.disable_motors()
         print("Test Cancelled")
@@ -343,6 +563,7 @@ if __name__ == '__main__':
         #f.flush()
         robot.disable_motors()
         raise e
-    
-    print("Test done")
-    robot.disable_motors()
+    finish(profile)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""
+Pipette settings, loaded once from pipettes.json.
+
+Each pipette is an immutable PipetteProfile with its plunger positions,
+A axis heights, speeds, plunger current and steps/mm, registered under
+its name and all of its aliases:
+
+    profile = get_profile('p10_single')
+    robot.move(c = profile.bottom)
+
+"""
+import os
+import json
+
+PROFILES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'pipettes.json')
+
+
+class PipetteProfile:
+    __slots__ = ('name', 'aliases', 'bottom', 'blowout', 'raise_position',
+                 'descend_position', 'pipette_speed', 'dispense_speed',
+                 'a_axis_speed', 'plunger_current', 'steps_per_mm')
+
+    def __init__(self, **settings):
+        missing = set(self.__slots__) - set(settings)
+        if missing:
+            raise ValueError('Pipette {} is missing {}'.format(
+                settings.get('name'), ', '.join(sorted(missing))))
+        for name in self.__slots__:
+            value = settings.pop(name)
+            object.__setattr__(
+                self, name, tuple(value) if name == 'aliases' else value)
+        if settings:
+            raise ValueError('Unknown pipette settings {}'.format(
+                ', '.join(sorted(settings))))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('PipetteProfile is immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError('PipetteProfile is immutable')
+
+    def __repr__(self):
+        return 'PipetteProfile({})'.format(', '.join(
+            '{}={!r}'.format(name, getattr(self, name))
+            for name in self.__slots__))
+
+
+_registries = {}
+
+
+def load_profiles(file_name=PROFILES_FILE):
+    '''Returns {name or alias: PipetteProfile}, read once per file'''
+    registry = _registries.get(file_name)
+    if registry is None:
+        with open(file_name) as f:
+            profiles = [PipetteProfile(**settings) for settings in json.load(f)]
+        registry = {}
+        for profile in profiles:
+            for name in (profile.name,) + profile.aliases:
+                registry[name] = profile
+        _registries[file_name] = registry
+    return registry
+
+
+def get_profile(pipette, file_name=PROFILES_FILE):
+    registry = load_profiles(file_name)
+    try:
+        return registry[pipette]
+    except KeyError:
+        raise KeyError('Unknown pipette {}, expected one of {}'.format(
+            pipette, ', '.join(sorted(registry)))) from None
+
+
+def resolve_name(pipette, file_name=PROFILES_FILE):
+    '''Registered name of a pipette name or alias, names that are not
+    registered (like those of retired pipettes) as they are'''
+    profile = load_profiles(file_name).get(pipette)
+    return profile.name if profile else pipette
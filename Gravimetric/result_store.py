@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+"""
+Append-only binary columnar result log.
+
+A store is a directory holding schema.json and one raw little-endian
+float64 file per column. Rows are appended to every column file and
+flushed, and readers only use as many rows as the shortest column holds,
+so a crash in the middle of a row loses that row and nothing else.
+ResultReader memory-maps the columns for zero-copy analysis:
+
+    store = ResultReader('results/Pipette_Data_10-18-26_12-00-00.cols')
+    store['volume'].mean()
+    store.to_csv('Pipette_Data.csv')
+
+ResultStore.writerow takes the same dicts as the csv.DictWriter in pip_test.
+"""
+import os
+import csv
+import json
+import time
+import optparse
+
+import numpy as np
+
+SCHEMA_FILE = 'schema.json'
+COLUMN_DTYPE = np.dtype('<f8')
+COLUMN_EXTENSION = '.f8'
+
+# time is seconds since the epoch, phase columns are seconds spent in the
+# phases of the cycle
+COLUMNS = ['time', 'dist', 'initial', 'final', 'delta', 'volume',
+           'ul_per_mm', 'cv', 'average', 'std',
+           'read_initial_s', 'aspirate_s', 'settle_s', 'read_final_s',
+           'dispense_s']
+
+# pip_test CSV field: column
+FIELD_COLUMNS = {
+    'Dist_Travel': 'dist',
+    'Initial_Weight(g)': 'initial',
+    'Final_Weight(g)': 'final',
+    'Delta_Weight(g)': 'delta',
+    'Volume(uL)': 'volume',
+    'uL/mm': 'ul_per_mm',
+    'CV': 'cv',
+    'average': 'average',
+    'std': 'std',
+}
+TIME_FORMAT = "%H:%M:%S"
+
+
+def _column_path(path, column):
+    return os.path.join(path, column + COLUMN_EXTENSION)
+
+
+def _read_schema(path):
+    with open(os.path.join(path, SCHEMA_FILE)) as f:
+        return json.load(f)['columns']
+
+
+def _row_count(path, columns):
+    '''Complete rows in the store, the shortest column decides'''
+    return min(
+        os.path.getsize(_column_path(path, column)) // COLUMN_DTYPE.itemsize
+        for column in columns)
+
+
+class ResultStore:
+    def __init__(self, path, columns=COLUMNS, sync=False):
+        '''Opens the store at path for appending, creating it if needed.
+        With sync every row is also fsynced to disk'''
+        self.path = path
+        self.sync = sync
+        if os.path.exists(os.path.join(path, SCHEMA_FILE)):
+            self.columns = _read_schema(path)
+            if self.columns != list(columns):
+                raise ValueError(
+                    'Store {} has columns {}'.format(path, self.columns))
+        else:
+            os.makedirs(path, exist_ok=True)
+            self.columns = list(columns)
+            for column in self.columns:
+                open(_column_path(path, column), 'ab').close()
+            with open(os.path.join(path, SCHEMA_FILE), 'w') as f:
+                json.dump({'columns': self.columns,
+                           'dtype': COLUMN_DTYPE.str}, f)
+        # drop the half written row of a crash before appending
+        rows = _row_count(path, self.columns)
+        self._files = []
+        for column in self.columns:
+            f = open(_column_path(path, column), 'r+b')
+            f.truncate(rows * COLUMN_DTYPE.itemsize)
+            f.seek(0, os.SEEK_END)
+            self._files.append(f)
+
+    @property
+    def name(self):
+        return self.path
+
+    def tell(self):
+        '''Rows in the store'''
+        return _row_count(self.path, self.columns)
+
+    def truncate(self, rows):
+        '''Drops every row after the first `rows`'''
+        for f in self._files:
+            f.truncate(rows * COLUMN_DTYPE.itemsize)
+            f.seek(0, os.SEEK_END)
+
+    def flush(self):
+        '''Rows are flushed as they are appended, this also syncs them'''
+        for f in self._files:
+            os.fsync(f.fileno())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        for f in self._files:
+            f.close()
+        self._files = []
+
+    def append(self, row):
+        '''Appends {column: value}, missing columns are stored as NaN and
+        time defaults to now'''
+        row = dict(row)
+        row.setdefault('time', time.time())
+        values = np.array(
+            [np.nan if row.get(column) is None else row[column]
+             for column in self.columns], dtype=COLUMN_DTYPE)
+        for f, value in zip(self._files, values):
+            f.write(value.tobytes())
+        for f in self._files:
+            f.flush()
+            if self.sync:
+                os.fsync(f.fileno())
+
+    def writeheader(self):
+        pass
+
+    def writerow(self, test_data):
+        '''csv.DictWriter compatible append of a pip_test result row'''
+        row = {column: test_data.get(field)
+               for field, column in FIELD_COLUMNS.items()}
+        row.update({
+            column: value for column, value in test_data.items()
+            if column in self.columns and column != 'time'
+        })
+        self.append(row)
+
+
+class ResultReader:
+    def __init__(self, path):
+        '''Memory-maps the complete rows of the store at path'''
+        self.path = path
+        self.columns = _read_schema(path)
+        rows = _row_count(path, self.columns)
+        self._data = {
+            column: np.memmap(_column_path(path, column), COLUMN_DTYPE,
+                              'r', shape=(rows,)) if rows
+            else np.empty(0, COLUMN_DTYPE)
+            for column in self.columns
+        }
+
+    def __len__(self):
+        return len(self._data['time'])
+
+    def __getitem__(self, column):
+        return self._data[column]
+
+    def to_records(self):
+        '''Copies the columns into one structured array'''
+        records = np.empty(len(self), [(c, COLUMN_DTYPE) for c in self.columns])
+        for column in self.columns:
+            records[column] = self._data[column]
+        return records
+
+    def to_csv(self, file_name):
+        '''Writes the rows with the same headers as pip_test's CSV files,
+        plus any phase timing columns'''
+        fields = list(FIELD_COLUMNS) + ['time'] + [
+            column for column in self.columns
+            if column not in FIELD_COLUMNS.values() and column != 'time']
+        with open(file_name, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fields)
+            writer.writeheader()
+            for i in range(len(self)):
+                row = {}
+                for column in self.columns:
+                    value = float(self._data[column][i])
+                    if np.isnan(value):
+                        value = None
+                    row[column] = value
+                for field, column in FIELD_COLUMNS.items():
+                    row[field] = row.pop(column)
+                row['time'] = time.strftime(
+                    TIME_FORMAT, time.localtime(row['time']))
+                writer.writerow(row)
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage='usage: %prog [options] store')
+    parser.add_option("-o", "--output", dest = "output", type = 'str', default = None, help = "CSV file to write, the store name with .csv by default")
+    (options, args) = parser.parse_args(args = None, values = None)
+    if len(args) != 1:
+        parser.error('Pass the store directory to convert')
+
+    store = args[0].rstrip('/\\')
+    output = options.output or os.path.splitext(store)[0] + '.csv'
+    ResultReader(store).to_csv(output)
+    print("Wrote", output)
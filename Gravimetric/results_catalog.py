@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+"""
+Catalog of the result files under results/, for queries across runs.
+
+Every Pipette_Data_[<rig>_]<pipette>_<time>[_<n>].csv (or .cols result store)
+is summarised once: pipette, rig, date, test type, cycles, mean volume,
+std and CV. Summaries are cached in results/catalog.json and only redone
+for files whose mtime or size changed, and queries filter the summary
+table with NumPy:
+
+    catalog = Catalog()
+    runs = catalog.query(pipette='P10', volume=1, days=30)
+    runs['date'], runs['cv']
+
+    python results_catalog.py -p P10 -v 1 --days 30
+"""
+import os
+import re
+import csv
+import json
+import time
+import datetime
+import optparse
+
+import numpy as np
+
+import result_store
+
+RESULTS_DIR = 'results'
+CATALOG_FILE = 'catalog.json'
+FILE_PREFIX = 'Pipette_Data_'
+STAMP_FORMAT = "%m-%d-%y_%H-%M-%S"
+# files written before the stamp had seconds
+MINUTE_STAMP_FORMAT = "%m-%d-%y_%H-%M"
+# the stamp may be followed by a number, for files started in the same second
+FILE_PATTERN = re.compile(
+    r'^Pipette_Data_(?P<name>.*?)_?'
+    r'(?P<stamp>\d\d-\d\d-\d\d_\d\d-\d\d(?:-\d\d)?)(?:_\d+)?'
+    r'\.(?:csv|cols)$')
+PIPETTE_PATTERN = re.compile(r'^[Pp]-?\d+')
+DEFAULT_TOLERANCE = 0.1     # relative, for volume queries
+SEC_PER_DAY = 86400
+
+SUMMARY_DTYPE = [
+    ('path', 'U256'), ('pipette', 'U32'), ('rig', 'U32'), ('test', 'U8'),
+    ('date', 'f8'), ('count', 'i8'), ('volume', 'f8'), ('std', 'f8'),
+    ('cv', 'f8'), ('min', 'f8'), ('max', 'f8')]
+
+
+def file_pipette(pipette):
+    '''Pipette name as written in result file names'''
+    return pipette.replace('_', '-')
+
+
+def parse_file_name(file_name):
+    '''Returns (rig, pipette, epoch seconds) of a result file name, None
+    for files that are not results. Older names have no pipette or rig'''
+    match = FILE_PATTERN.match(os.path.basename(file_name))
+    if not match:
+        return None
+    parts = match.group('name').split('_') if match.group('name') else []
+    pipette = ''
+    if parts and PIPETTE_PATTERN.match(parts[-1]):
+        pipette = parts.pop().replace('-', '_')
+    stamp = match.group('stamp')
+    date = datetime.datetime.strptime(
+        stamp, STAMP_FORMAT if stamp.count('-') == 4 else MINUTE_STAMP_FORMAT)
+    return '_'.join(parts), pipette, date.timestamp()
+
+
+def file_stat(path):
+    '''(mtime, size) of a result file, or of all files of a result store'''
+    if not os.path.isdir(path):
+        stat = os.stat(path)
+        return stat.st_mtime, stat.st_size
+    stats = [os.stat(os.path.join(path, name)) for name in os.listdir(path)]
+    return (max(stat.st_mtime for stat in stats),
+            sum(stat.st_size for stat in stats))
+
+
+def read_volumes(path):
+    '''Returns the cycle distances and volumes of a result file, without
+    const_vol's trailing summary row, and the test type, Gravi runs are
+    the ones recording uL/mm'''
+    if os.path.isdir(path):
+        store = result_store.ResultReader(path)
+        cycles = np.isnan(store['cv'])
+        test = 'Fixed' if np.isnan(store['ul_per_mm']).all() else 'Gravi'
+        return (np.asarray(store['dist'][cycles]),
+                np.asarray(store['volume'][cycles]), test)
+    with open(path, newline='') as f:
+        rows = [
+            row for row in csv.DictReader(f)
+            if row['Volume(uL)'] and not row.get('CV')
+        ]
+    test = 'Gravi' if any(row.get('uL/mm') for row in rows) else 'Fixed'
+    return (np.array([float(row['Dist_Travel']) for row in rows]),
+            np.array([float(row['Volume(uL)']) for row in rows]), test)
+
+
+def summarise(path):
+    name = parse_file_name(path)
+    if name is None:
+        return None
+    rig, pipette, date = name
+    _, volumes, test = read_volumes(path)
+    volumes = np.abs(volumes)
+    count = len(volumes)
+    mean = float(volumes.mean()) if count else float('nan')
+    std = float(volumes.std(ddof=1)) if count > 1 else float('nan')
+    return {
+        'path': path,
+        'pipette': pipette,
+        'rig': rig,
+        'test': test,
+        'date': date,
+        'count': count,
+        'volume': mean,
+        'std': std,
+        'cv': std / mean * 100 if mean else float('nan'),
+        'min': float(volumes.min()) if count else float('nan'),
+        'max': float(volumes.max()) if count else float('nan'),
+    }
+
+
+class Catalog:
+    def __init__(self, results_dir=RESULTS_DIR):
+        self.results_dir = results_dir
+        self.catalog_file = os.path.join(results_dir, CATALOG_FILE)
+        self._entries = {}
+        if os.path.exists(self.catalog_file):
+            with open(self.catalog_file) as f:
+                self._entries = json.load(f)
+        self._table = None
+
+    def refresh(self):
+        '''Summarises new and changed files, forgets removed ones and saves
+        the catalog if anything changed. Returns the number of files read'''
+        paths = [
+            os.path.join(self.results_dir, name)
+            for name in os.listdir(self.results_dir)
+            if name.startswith(FILE_PREFIX)
+        ]
+        changed = 0
+        entries = {}
+        for path in paths:
+            mtime, size = file_stat(path)
+            entry = self._entries.get(path)
+            if entry is None or entry['mtime'] != mtime \
+                    or entry['size'] != size:
+                entry = {'mtime': mtime, 'size': size,
+                         'summary': summarise(path)}
+                changed += 1
+            entries[path] = entry
+        if changed or len(entries) != len(self._entries):
+            self._entries = entries
+            self._table = None
+            self.save()
+        return changed
+
+    def save(self):
+        temp_file = self.catalog_file + '.tmp'
+        with open(temp_file, 'w') as f:
+            json.dump(self._entries, f)
+        os.replace(temp_file, self.catalog_file)
+
+    def table(self):
+        '''Structured array of all run summaries, oldest first'''
+        if self._table is None:
+            rows = [
+                tuple(entry['summary'][field] for field, _ in SUMMARY_DTYPE)
+                for entry in self._entries.values() if entry['summary']
+            ]
+            self._table = np.sort(
+                np.array(rows, dtype=SUMMARY_DTYPE), order='date')
+        return self._table
+
+    def query(self, pipette=None, volume=None, tolerance=DEFAULT_TOLERANCE,
+              test=None, rig=None, since=None, until=None, days=None,
+              max_cv=None):
+        '''Runs matching every given filter. volume matches mean volumes
+        within tolerance (relative), since/until are epoch seconds and
+        days keeps the runs of the last days'''
+        table = self.table()
+        keep = np.ones(len(table), dtype=bool)
+        if pipette is not None:
+            keep &= np.char.lower(table['pipette']) == pipette.lower()
+        if volume is not None:
+            keep &= np.abs(table['volume'] - volume) <= tolerance * volume
+        if test is not None:
+            keep &= table['test'] == test
+        if rig is not None:
+            keep &= table['rig'] == rig
+        if days is not None:
+            since = max(since or 0, time.time() - days * SEC_PER_DAY)
+        if since is not None:
+            keep &= table['date'] >= since
+        if until is not None:
+            keep &= table['date'] <= until
+        if max_cv is not None:
+            keep &= table['cv'] <= max_cv
+        return table[keep]
+
+    def trend(self, **filters):
+        '''(dates, CVs) of the matching runs, oldest first'''
+        runs = self.query(**filters)
+        return runs['date'], runs['cv']
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage='usage: %prog [options] ')
+    parser.add_option("-r", "--results", dest = "results", type = 'str', default = RESULTS_DIR, help = "Results folder")
+    parser.add_option("-p", "--p", dest = "pipette", type = 'str', default = None, help = "Pipette Type as string")
+    parser.add_option("-v", "--v", dest = "volume", type = 'float', default = None, help = "Mean volume in uL")
+    parser.add_option("--tolerance", dest = "tolerance", type = 'float', default = DEFAULT_TOLERANCE, help = "Relative volume tolerance")
+    parser.add_option("-t", "--test", dest = "test", type = 'str', default = None, help = "Test Type, Gravi or Fixed")
+    parser.add_option("--rig", dest = "rig", type = 'str', default = None, help = "Rig name")
+    parser.add_option("-d", "--days", dest = "days", type = 'float', default = None, help = "Only runs of the last days")
+    parser.add_option("--max_cv", dest = "max_cv", type = 'float', default = None, help = "Only runs with a CV up to this %")
+    (options, args) = parser.parse_args(args = None, values = None)
+
+    catalog = Catalog(options.results)
+    print("Read", catalog.refresh(), "new or changed files")
+    runs = catalog.query(pipette = options.pipette, volume = options.volume, tolerance = options.tolerance, test = options.test, rig = options.rig, days = options.days, max_cv = options.max_cv)
+    for run in runs:
+        print("%s  %-10s %-8s %-6s %4d cycles  %8.3f uL  CV %6.3f%%  %s" % (
+            datetime.datetime.fromtimestamp(run['date']).strftime("%Y-%m-%d %H:%M"),
+            run['pipette'] or '?', run['rig'], run['test'], run['count'],
+            run['volume'], run['cv'], os.path.basename(run['path'])))
+    if len(runs):
+        print("%d runs, mean CV %.3f%%" % (len(runs), np.nanmean(runs['cv'])))
@@ -0,0 +1,68 @@
+"""
+Fixed-capacity ring buffer of NumPy structured records.
+
+Memory is allocated once; when full, each append overwrites the oldest
+record, so long unattended runs keep a flat footprint.
+"""
+import numpy as np
+from numpy.lib import recfunctions
+
+
+class RingBuffer:
+    def __init__(self, dtype, capacity):
+        self._data = np.zeros(capacity, dtype=dtype)
+        self.capacity = capacity
+        # total number of records ever appended
+        self._count = 0
+
+    def __len__(self):
+        return min(self._count, self.capacity)
+
+    @property
+    def evicted(self):
+        '''Number of records that were overwritten'''
+        return max(0, self._count - self.capacity)
+
+    @property
+    def dtype(self):
+        return self._data.dtype
+
+    def append(self, record):
+        '''Adds a record given as a tuple in dtype field order'''
+        self._data[self._count % self.capacity] = record
+        self._count += 1
+
+    def clear(self):
+        self._count = 0
+
+    def latest(self, n=1):
+        '''Returns a copy of the last n records, oldest first'''
+        n = min(n, len(self))
+        indices = np.arange(self._count - n, self._count) % self.capacity
+        return self._data[indices]
+
+    def after(self, field, value):
+        '''Returns a copy of the records whose field is above value, oldest
+        first. The field must not decrease from one record to the next, so
+        only the records returned are copied'''
+        n = len(self)
+        start = self._count - n
+        column = self._data[field]
+        low, high = 0, n
+        while low < high:
+            middle = (low + high) // 2
+            if column[(start + middle) % self.capacity] > value:
+                high = middle
+            else:
+                low = middle + 1
+        return self.latest(n - low)
+
+    def export(self):
+        '''Returns a copy of all records, oldest first'''
+        return self.latest(len(self))
+
+    def to_csv(self, file_name):
+        records = self.export()
+        np.savetxt(
+            file_name, recfunctions.structured_to_unstructured(records),
+            delimiter=',', header=','.join(records.dtype.names), comments='')
@@ -0,0 +1,98 @@
+"""
+Running mean, standard deviation and CV of the dispensed volumes.
+
+RunningStats updates with Welford's method, so the statistics are known
+after every cycle without keeping the volumes. sequential_decision uses
+them to end a constant volume run early, once the CV is known precisely
+enough or has clearly failed its spec.
+"""
+import math
+
+# two sided 95% Student t critical values by degrees of freedom
+T_95 = [12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262,
+        2.228, 2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101,
+        2.093, 2.086, 2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052,
+        2.048, 2.045, 2.042]
+Z_95 = 1.96
+MIN_COUNT = 5
+
+PRECISE = 'precise'
+FAILED = 'failed'
+
+
+def t_95(degrees_of_freedom):
+    if degrees_of_freedom < 1:
+        return math.inf
+    if degrees_of_freedom <= len(T_95):
+        return T_95[degrees_of_freedom - 1]
+    return Z_95
+
+
+class RunningStats:
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+
+    def state(self):
+        '''Everything needed to carry on later, see from_state'''
+        return [self.count, self.mean, self._m2]
+
+    @classmethod
+    def from_state(cls, state):
+        stats = cls()
+        stats.count, stats.mean, stats._m2 = state
+        return stats
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+
+    @property
+    def variance(self):
+        '''Sample variance, 0 until there are two values'''
+        return self._m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    @property
+    def std(self):
+        return math.sqrt(self.variance)
+
+    @property
+    def cv(self):
+        '''Coefficient of variation in % of the absolute mean, undefined
+        (inf) until there are two values'''
+        if self.count < 2 or not self.mean:
+            return math.inf
+        return self.std / abs(self.mean) * 100
+
+    def mean_interval(self):
+        '''95% confidence interval of the mean'''
+        half_width = t_95(self.count - 1) * self.std / math.sqrt(self.count) \
+            if self.count else math.inf
+        return self.mean - half_width, self.mean + half_width
+
+    def cv_interval(self):
+        '''Approximate 95% confidence interval of the CV in %, from the
+        normal approximation of its standard error'''
+        if self.count < 2 or not self.mean:
+            return 0.0, math.inf
+        cv = self.cv / 100
+        standard_error = cv * math.sqrt((1 + 2 * cv ** 2) / (2 * self.count))
+        half_width = t_95(self.count - 1) * standard_error * 100
+        return max(self.cv - half_width, 0.0), self.cv + half_width
+
+
+def sequential_decision(stats, precision=None, cv_spec=None,
+                        min_count=MIN_COUNT):
+    '''PRECISE once the CV interval is no wider than +-precision (% points),
+    FAILED once its lower end is above cv_spec (%), None to keep going'''
+    if stats.count < min_count:
+        return None
+    low, high = stats.cv_interval()
+    if cv_spec is not None and low > cv_spec:
+        return FAILED
+    if precision is not None and (high - low) / 2 <= precision:
+        return PRECISE
+    return None
@@ -0,0 +1,168 @@
+"""
+Scale backends for the gravimetric tests.
+
+ScaleBackend is what the test scripts need from a balance: read_mass,
+stream and tare. RagwagScale drives the real balance through
+../Equipment/Ragwag_Scale_Framework; SimulatedScale stands in for it with
+configurable latency, noise, drift, evaporation and settling, and can be
+attached to a VirtualSmoothie so aspirates and dispenses change its mass.
+Given a sim_clock.SimulatedClock it reads without waiting, for dry runs.
+"""
+import os
+import sys
+import math
+import time
+import random
+import threading
+
+# water
+DEFAULT_DENSITY = 0.001     # g/uL
+DEFAULT_MASS = 50.0         # g in the vessel on the pan
+DEFAULT_LATENCY = 0.1       # s per reading
+DEFAULT_NOISE = 0.00002     # g standard deviation
+DEFAULT_SETTLE_TIME = 0.3   # s time constant after a mass change
+# changes older than this many settle times count as settled
+SETTLED_TIME_CONSTANTS = 20
+
+
+class ScaleBackend:
+    # time module, or a sim_clock.SimulatedClock
+    clock = time
+
+    def read_mass(self):
+        '''Returns the current reading in grams'''
+        raise NotImplementedError
+
+    def tare(self):
+        raise NotImplementedError
+
+    def stream(self, interval=0):
+        '''Yields (clock.monotonic(), mass) readings while iterated'''
+        while True:
+            mass = self.read_mass()
+            yield self.clock.monotonic(), mass
+            if interval:
+                self.clock.sleep(interval)
+
+
+class RagwagScale(ScaleBackend):
+    def __init__(self, port):
+        # the framework lives next to this repo, not in it
+        sys.path.insert(0, os.path.abspath('../Equipment'))
+        import Ragwag_Scale_Framework
+        self._scale = Ragwag_Scale_Framework.Ragwag_Scale(port)
+
+    def read_mass(self):
+        return self._scale.read_mass()
+
+    def tare(self):
+        if not hasattr(self._scale, 'tare'):
+            raise NotImplementedError('Ragwag_Scale has no tare command')
+        self._scale.tare()
+
+
+class SimulatedScale(ScaleBackend):
+    def __init__(self, mass=DEFAULT_MASS, latency=DEFAULT_LATENCY,
+                 noise=DEFAULT_NOISE, drift=0, evaporation=0,
+                 settle_time=DEFAULT_SETTLE_TIME, density=DEFAULT_DENSITY,
+                 seed=None, clock=time):
+        '''drift and evaporation are in g/s, evaporation only lowers the
+        mass while drift is the balance's own zero drift. Times are
+        clock.monotonic() values'''
+        self.clock = clock
+        self.latency = latency
+        self.noise = noise
+        self.drift = drift
+        self.evaporation = evaporation
+        self.settle_time = settle_time
+        self.density = density
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._start = clock.monotonic()
+        self._tare = 0
+        # (clock.monotonic(), grams) mass changes, the first is the vessel
+        self._changes = [(self._start, mass)]
+        # uL held in the tip of each plunger axis
+        self._held = {}
+        self._ul_per_mm = None
+        self._liquid_level = None
+
+    def _mass_at(self, now):
+        '''Settled mass on the pan at `now`, without noise or drift'''
+        mass = 0
+        for at, grams in self._changes:
+            if at <= now:
+                # first order approach to every change, like the pan does
+                mass += grams * (1 - math.exp(-(now - at) / self.settle_time)) \
+                    if self.settle_time and at > self._start else grams
+        return mass - self.evaporation * (now - self._start)
+
+    def read_mass(self):
+        if self.latency:
+            self.clock.sleep(self.latency)
+        now = self.clock.monotonic()
+        with self._lock:
+            mass = self._mass_at(now) - self._tare
+        return mass + self.drift * (now - self._start) \
+            + self._random.gauss(0, self.noise)
+
+    def tare(self):
+        now = self.clock.monotonic()
+        with self._lock:
+            self._tare = self._mass_at(now) + self.drift * (now - self._start)
+
+    def settled_at(self, tolerance):
+        '''Earliest clock.monotonic() from now on at which the pan is
+        within tolerance g of where the mass changes so far settle'''
+        now = self.clock.monotonic()
+        if not self.settle_time:
+            return now
+        horizon = now - SETTLED_TIME_CONSTANTS * self.settle_time
+        with self._lock:
+            pending = [(at, grams) for at, grams in self._changes
+                       if at > max(self._start, horizon)]
+        at = now
+        step = self.settle_time / 10
+        while at < now + SETTLED_TIME_CONSTANTS * self.settle_time:
+            unsettled = sum(
+                abs(grams) * (math.exp(-(at - change) / self.settle_time)
+                              if at > change else 1)
+                for change, grams in pending)
+            if unsettled <= tolerance:
+                break
+            at += step
+        return at
+
+    def add_mass(self, grams, at=None):
+        '''Puts grams on (negative: takes them off) the pan at time `at`'''
+        with self._lock:
+            self._changes.append(
+                (self.clock.monotonic() if at is None else at, grams))
+
+    def aspirate(self, volume, at=None):
+        self.add_mass(-volume * self.density, at)
+
+    def dispense(self, volume, at=None):
+        self.add_mass(volume * self.density, at)
+
+    # ----------- Virtual robot --------------- #
+
+    def attach(self, virtual_smoothie, ul_per_mm, liquid_level):
+        '''Follows the plunger moves of a VirtualSmoothie. Raising a plunger
+        with its mount at or below liquid_level draws ul_per_mm per mm from
+        the pan, lowering it anywhere puts held liquid back'''
+        self._ul_per_mm = ul_per_mm
+        self._liquid_level = liquid_level
+        if self._plunger_moved not in virtual_smoothie.plunger_listeners:
+            virtual_smoothie.plunger_listeners.append(self._plunger_moved)
+
+    def _plunger_moved(self, plunger, distance, mount_height, at):
+        held = self._held.get(plunger, 0)
+        if distance > 0 and mount_height <= self._liquid_level:
+            volume = distance * self._ul_per_mm
+            self._held[plunger] = held + volume
+            self.aspirate(volume, at)
+        elif distance < 0 and held:
+            volume = min(held, -distance * self._ul_per_mm)
+            self._held[plunger] = held - volume
+            self.dispense(volume, at)
@@ -0,0 +1,111 @@
+"""
+Background sampler that streams scale readings into a timestamped ring
+buffer, so reading the mass in the test loop is a lookup instead of a
+blocking serial query, and the whole mass trace of a run is kept.
+
+    sampler = ScaleSampler(scale).start()
+    mass = sampler.read_mass()      # median of the latest samples
+    sampler.stop()
+
+"""
+import time
+import threading
+
+import numpy as np
+
+import ring_buffer
+
+SAMPLE_DTYPE = [('time', 'f8'), ('mass', 'f8')]
+# ~3 h at 10 readings per second
+DEFAULT_CAPACITY = 100000
+DEFAULT_MEDIAN_SAMPLES = 5
+FIRST_SAMPLE_TIMEOUT = 10
+
+
+class ScaleSampler:
+    def __init__(self, scale, capacity=DEFAULT_CAPACITY, interval=0,
+                 median_samples=DEFAULT_MEDIAN_SAMPLES):
+        '''scale is anything with read_mass(), polled every interval s'''
+        self.scale = scale
+        self.interval = interval
+        self.median_samples = median_samples
+        self._samples = ring_buffer.RingBuffer(SAMPLE_DTYPE, capacity)
+        self._new_sample = threading.Condition()
+        self._thread = None
+        self._running = False
+        # what stopped the sampling thread, raised to the readers
+        self._error = None
+
+    def start(self):
+        self._running = True
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        if self._thread:
+            self._thread.join()
+        self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _run(self):
+        while self._running:
+            try:
+                mass = self.scale.read_mass()
+            except Exception as e:
+                with self._new_sample:
+                    self._error = e
+                    self._running = False
+                    self._new_sample.notify_all()
+                return
+            if mass is not None:
+                with self._new_sample:
+                    self._samples.append((time.monotonic(), mass))
+                    self._new_sample.notify_all()
+            if self.interval:
+                time.sleep(self.interval)
+
+    def wait_for_sample(self, after=0, timeout=FIRST_SAMPLE_TIMEOUT):
+        '''Blocks until there is a sample taken after time.monotonic()
+        value `after`, returns False on timeout. Raises the error that
+        stopped the sampling'''
+        with self._new_sample:
+            found = self._new_sample.wait_for(
+                lambda: self._error is not None or (
+                    len(self._samples)
+                    and self._samples.latest()['time'][0] > after),
+                timeout)
+            if self._error is not None:
+                raise self._error
+            return found
+
+    def latest(self, n=1):
+        '''Returns the last n (time, mass) samples, oldest first'''
+        with self._new_sample:
+            return self._samples.latest(n)
+
+    def trace(self, since=0):
+        '''Returns the buffered samples taken after `since`'''
+        with self._new_sample:
+            return self._samples.after('time', since)
+
+    def median(self, n=None):
+        return float(np.median(self.latest(n or self.median_samples)['mass']))
+
+    def read_mass(self):
+        '''Median of the latest samples, same interface as the scale.
+        Waits for a sample taken after the call'''
+        if not self.wait_for_sample(after=time.monotonic()):
+            raise RuntimeError('No readings from the scale')
+        return self.median()
+
+    def to_csv(self, file_name):
+        with self._new_sample:
+            self._samples.to_csv(file_name)
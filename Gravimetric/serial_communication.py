@@ -1,9 +1,14 @@
 import serial
 from serial.tools import list_ports
 import contextlib
+import weakref
+import time
 import os
+import re
 
 DRIVER_ACK = b'ok\r\nok\r\n'
+ACK_LINE = b'ok'
+LINE_END = b'\r\n'
 RECOVERY_TIMEOUT = 10
 DEFAULT_SERIAL_TIMEOUT = 5
 DEFAULT_WRITE_TIMEOUT = 30
@@ -18,6 +23,110 @@ ALARM_KEYWORD = b'ALARM'
 
 BAUDRATE = 115200
 
+# Set to a latency.LatencyRecorder to time every command
+latency_recorder = None
+
+# Smoothie acknowledges every G/M code on a line with its own 'ok'
+GCODE_PATTERN = re.compile(r'[GM]\d+(?:\.\d+)?')
+
+
+class SmoothieError(Exception):
+    '''Smoothie answered a command with an error line'''
+    def __init__(self, command, response):
+        super().__init__('{}: {}'.format(command, response))
+        self.command = command
+        self.response = response
+
+
+class SmoothieAlarm(SmoothieError):
+    '''Smoothie raised an ALARM and halted, needs M999 to recover'''
+
+
+class ResponseReader:
+    '''Frames Smoothie responses as bytes arrive on a connection.
+
+    Bytes that are not part of the response being read stay buffered for
+    the next one, and acks of commands that timed out are consumed before
+    the next command's, so no ack is ever thrown away or misattributed.
+    '''
+    def __init__(self, serial_connection):
+        self._connection = serial_connection
+        self._buffer = bytearray()
+        self._owed_acks = 0
+        # when the first byte of the current response was read
+        self.first_byte_at = None
+
+    def clear(self):
+        self._buffer.clear()
+        self._owed_acks = 0
+
+    def _fill(self):
+        waiting = self._connection.in_waiting
+        data = self._connection.read(waiting or 1)
+        if data and self.first_byte_at is None:
+            self.first_byte_at = time.monotonic()
+        self._buffer += data
+
+    def _read_line(self, deadline):
+        while True:
+            end = self._buffer.find(LINE_END)
+            if end >= 0:
+                line = bytes(self._buffer[:end])
+                del self._buffer[:end + len(LINE_END)]
+                return line
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+            self._fill()
+
+    def read_acks(self, command, count, timeout=None):
+        '''Returns the response lines for `count` acks of a command, or
+        None on timeout. Raises SmoothieError on error and ALARM lines'''
+        if timeout is None:
+            timeout = self._connection.timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+        self.first_byte_at = time.monotonic() if self._buffer else None
+
+        while self._owed_acks:
+            line = self._read_line(deadline)
+            if line is None:
+                self._owed_acks += count
+                return None
+            if line == ACK_LINE:
+                self._owed_acks -= 1
+
+        lines = []
+        errors = []
+        while count:
+            line = self._read_line(deadline)
+            if line is None:
+                self._owed_acks += count
+                return None
+            if line == ACK_LINE:
+                count -= 1
+            elif ALARM_KEYWORD in line:
+                # halted, the remaining acks will not come
+                raise SmoothieAlarm(command, line.decode())
+            else:
+                if ERROR_KEYWORD in line:
+                    errors.append(line)
+                lines.append(line)
+
+        if errors:
+            raise SmoothieError(command, b' '.join(errors).decode())
+        return b'\r\n'.join(lines)
+
+
+_readers = weakref.WeakKeyDictionary()
+
+
+def get_reader(serial_connection):
+    '''Returns the ResponseReader that owns a connection's input'''
+    reader = _readers.get(serial_connection)
+    if reader is None:
+        reader = _readers[serial_connection] = \
+            ResponseReader(serial_connection)
+    return reader
+
 
 def get_ports(device_name):
     '''Returns all serial devices with a given name'''
@@ -39,35 +148,25 @@ def serial_with_temp_timeout(serial_connection, timeout):
     serial_connection.timeout = saved_timeout
 
 
-def _parse_smoothie_response(response):
-    if ERROR_KEYWORD in response or ALARM_KEYWORD in response:
-        print("[SMOOTHIE ISSUE]: ", response)
-
-    if DRIVER_ACK in response:
-        parsed_response = response.split(DRIVER_ACK)[0]
-        return parsed_response
-    else:
-        return None
+def count_acks(command):
+    '''Returns the number of acks Smoothie sends back for a command line'''
+    return max(1, len(GCODE_PATTERN.findall(command)))
 
 
 def clear_buffer(serial_connection):
+    '''Discards all pending input, only meant for recovering from errors'''
     serial_connection.reset_input_buffer()
+    get_reader(serial_connection).clear()
 
 
-def _write_to_device_and_return(cmd, device_connection):
+def _write_to_device_and_return(cmd, device_connection, timeout=None):
     '''Writes to a serial device.
     - Formats command
     - Wait for ack return
     - return parsed response'''
-    command = cmd + '\r\n'
-    device_connection.write(command.encode())
-
-    response = device_connection.read_until(DRIVER_ACK)
-
-    clean_response = _parse_smoothie_response(response)
-    if clean_response:
-        clean_response = clean_response.decode()
-    return clean_response
+    sent_at = write(cmd, device_connection)
+    return read_acks(
+        device_connection, count_acks(cmd), timeout, cmd, sent_at)
 
 
 def _connect(port_name, baudrate):
@@ -80,18 +179,44 @@ def _connect(port_name, baudrate):
 def write_and_return(
         command, serial_connection, timeout=DEFAULT_WRITE_TIMEOUT):
     '''Write a command and return the response'''
-    clear_buffer(serial_connection)
-    with serial_with_temp_timeout(
-            serial_connection, timeout) as device_connection:
-        response = _write_to_device_and_return(command, device_connection)
+    return _write_to_device_and_return(command, serial_connection, timeout)
+
+
+def write(command, serial_connection):
+    '''Writes a command without waiting for its acknowledgement
+    - returns the time.monotonic() it was sent at'''
+    sent_at = time.monotonic()
+    serial_connection.write((command + '\r\n').encode())
+    if latency_recorder:
+        latency_recorder.record(
+            command, 'write', time.monotonic() - sent_at)
+    return sent_at
+
+
+def read_acks(serial_connection, count, timeout=DEFAULT_WRITE_TIMEOUT,
+              command='', sent_at=None):
+    '''Reads the acks of a previously written command
+    - returns the parsed response, or None if the acks never arrived'''
+    reader = get_reader(serial_connection)
+    response = reader.read_acks(command, count, timeout)
+    if response is not None:
+        response = response.decode()
+        if latency_recorder and sent_at is not None:
+            latency_recorder.record(
+                command, 'ack', time.monotonic() - sent_at)
+            if reader.first_byte_at is not None:
+                latency_recorder.record(
+                    command, 'first_byte',
+                    max(0, reader.first_byte_at - sent_at))
     return response
 
 
-def connect(device_name=SMOOTHIE_PORT_ID):
+def connect(device_name=SMOOTHIE_PORT_ID, port=None):
     '''
     Creates a serial connection
     :param device_name: defaults to 'Smoothieboard'
+    :param port: port to open directly instead of searching by device name
     :return: serial.Serial connection
     '''
-    smoothie_port = get_ports(device_name=device_name)[0]
+    smoothie_port = port or get_ports(device_name=device_name)[0]
     return _connect(port_name=smoothie_port, baudrate=BAUDRATE)
\ No newline at end of file
@@ -0,0 +1,55 @@
+"""
+Ends scale waits as soon as the mass reading is stable.
+
+The detector looks at the samples of a ScaleSampler over a rolling time
+window and calls the reading settled once both the fitted slope and the
+standard deviation in that window are below their limits, or gives up
+after a hard timeout.
+"""
+import time
+
+import numpy as np
+
+DEFAULT_WINDOW = 1.0        # s
+DEFAULT_MAX_SLOPE = 0.0005  # g/s
+DEFAULT_MAX_STD = 0.0002    # g
+DEFAULT_TIMEOUT = 10        # s
+MIN_SAMPLES = 3
+POLL_INTERVAL = 0.05
+
+
+class SettleDetector:
+    def __init__(self, window=DEFAULT_WINDOW, max_slope=DEFAULT_MAX_SLOPE,
+                 max_std=DEFAULT_MAX_STD, timeout=DEFAULT_TIMEOUT):
+        self.window = window
+        self.max_slope = max_slope
+        self.max_std = max_std
+        self.timeout = timeout
+
+    def is_stable(self, samples):
+        '''True if the (time, mass) samples of one window are settled'''
+        if len(samples) < MIN_SAMPLES:
+            return False
+        times = samples['time'] - samples['time'][0]
+        slope = np.polyfit(times, samples['mass'], 1)[0]
+        return abs(slope) <= self.max_slope \
+            and np.std(samples['mass']) <= self.max_std
+
+    def wait(self, sampler, since=None):
+        '''Waits for the readings taken after `since` (time.monotonic(),
+        default now) to settle. Returns the median mass of the settled
+        window, the seconds waited and whether it really settled'''
+        start = time.monotonic()
+        if since is None:
+            since = start
+        while True:
+            now = time.monotonic()
+            samples = sampler.trace(max(since, now - self.window))
+            # only judge complete windows
+            if now - since >= self.window and self.is_stable(samples):
+                return float(np.median(samples['mass'])), now - start, True
+            if now - start >= self.timeout:
+                return sampler.median(), now - start, False
+            sampler.wait_for_sample(
+                after=samples['time'][-1] if len(samples) else now,
+                timeout=POLL_INTERVAL)
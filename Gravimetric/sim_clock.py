@@ -0,0 +1,39 @@
+"""
+Simulated clock for dry runs.
+
+Has the monotonic, time and sleep functions of the time module, so it can
+be passed wherever a module takes a clock. Sleeping moves the clock on at
+once instead of waiting, so a whole pip_test run plays out in the time
+its computation takes while everything it waited for is still counted:
+
+    clock = SimulatedClock()
+    driver = driver_3_0.SmoothieDriver_3_0_0(clock=clock)
+    ...
+    print(clock.elapsed)
+
+"""
+import time
+
+
+class SimulatedClock:
+    def __init__(self, start=None):
+        '''Starts at the real time.monotonic() unless start is given'''
+        self.start = time.monotonic() if start is None else start
+        self._now = self.start
+        # time() is the real epoch time of the start plus simulated time
+        self._epoch = time.time() - self._now
+
+    def monotonic(self):
+        return self._now
+
+    def time(self):
+        return self._epoch + self._now
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            self._now += seconds
+
+    @property
+    def elapsed(self):
+        '''Simulated seconds since the start'''
+        return self._now - self.start
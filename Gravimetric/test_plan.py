@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+"""
+Runs a queue of experiments back to back over one robot and scale
+connection, checkpointing after every cycle so an interrupted plan
+resumes at the cycle it stopped at.
+
+The plan is a JSON file. "options" are pip_test options shared by the
+whole plan (ports, scale, settling, ...), every experiment overrides the
+pip_test settings it names, out of EXPERIMENT_SETTINGS:
+
+    {
+        "options": ["-P", "-A", "-S", "COM7"],
+        "experiments": [
+            {"pipette": "P10", "test": "Gravi", "max_dist": 8},
+            {"pipette": "P10", "test": "Fixed", "volume": 5, "calibrated": true, "cycles": 10},
+            {"pipette": "P50", "test": "Fixed", "dist": 13, "cycles": 20}
+        ]
+    }
+
+    python test_plan.py -f plan.json        # run again to resume
+
+With "-n" in the options the whole plan is dry run on a simulated clock,
+printing how long it will take.
+
+The checkpoint (plan.json.checkpoint by default) holds the experiment and
+cycle reached, the results file with its size at that cycle and any
+running statistics. It is replaced atomically, and removed once the plan
+is done.
+"""
+import os
+import copy
+import json
+import optparse
+
+import pip_test
+import pipette_profiles
+
+# pip_test settings an experiment may set. The others are read once when
+# the robot and scale are set up, so they can only be plan options
+EXPERIMENT_SETTINGS = [
+    'pipette', 'test', 'cycles', 'dist', 'volume', 'calibrated', 'max_dist',
+    'aspir_incre', 'sweep', 'sweep_tolerance', 'sweep_points', 'min_step',
+    'sweep_max', 'margin', 'store', 'cv_precision', 'cv_spec', 'min_cycles',
+    'sim_ul_mm',
+]
+
+class Checkpoint:
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self._data = {'experiment': 0, 'state': None}
+        if os.path.exists(file_name):
+            with open(file_name) as f:
+                self._data = json.load(f)
+
+    @property
+    def experiment(self):
+        '''Index of the experiment to run next'''
+        return self._data['experiment']
+
+    @property
+    def state(self):
+        '''Last saved cycle state of that experiment, None to start it'''
+        return self._data['state']
+
+    def save(self, state):
+        self._data['state'] = state
+        self._write()
+
+    def next_experiment(self):
+        self._data = {'experiment': self.experiment + 1, 'state': None}
+        self._write()
+
+    def _write(self):
+        temp_file = self.file_name + '.tmp'
+        with open(temp_file, 'w') as f:
+            json.dump(self._data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_file, self.file_name)
+
+    def remove(self):
+        os.remove(self.file_name)
+
+
+def experiment_options(base, experiment):
+    '''pip_test options of one experiment'''
+    options = copy.copy(base)
+    for name, value in experiment.items():
+        if name not in EXPERIMENT_SETTINGS:
+            if hasattr(options, name):
+                raise ValueError(
+                    'Experiment setting {} can only be a plan option'.format(name))
+            raise ValueError('Unknown experiment setting {}'.format(name))
+        setattr(options, name, value)
+    return options
+
+
+def run_plan(plan, scale, checkpoint):
+    '''Runs the experiments of the plan from where the checkpoint is'''
+    base = pip_test.options
+    # resolve every pipette first, a typo should not stop the plan halfway
+    profiles = [
+        pipette_profiles.get_profile(experiment.get('pipette', base.pipette))
+        for experiment in plan['experiments']
+    ]
+    for index, experiment in enumerate(plan['experiments']):
+        if index < checkpoint.experiment:
+            continue
+        pip_test.options = experiment_options(base, experiment)
+        print("Experiment %d of %d: %s" % (index + 1, len(profiles), experiment),
+              "(resuming after cycle %d)" % checkpoint.state['cycle'] if checkpoint.state else "")
+        pip_test.run_test(profiles[index], scale, checkpoint)
+        checkpoint.next_experiment()
+    pip_test.options = base
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage='usage: %prog [options] ')
+    parser.add_option("-f", "--file", dest = "file", type = 'str', default = 'plan.json', help = "Test plan JSON file")
+    parser.add_option("-k", "--checkpoint", dest = "checkpoint", type = 'str', default = None, help = "Checkpoint file, <plan>.checkpoint by default")
+    (options, args) = parser.parse_args(args = None, values = None)
+
+    with open(options.file) as f:
+        plan = json.load(f)
+    (pip_test.options, _) = pip_test.build_parser().parse_args(args = plan.get('options', []), values = None)
+    #check every experiment before connecting, not halfway through the plan
+    for experiment in plan['experiments']:
+        experiment_options(pip_test.options, experiment)
+    #a dry run must not leave a checkpoint the real run would resume from
+    default_checkpoint = options.file + ('.dry_run' if pip_test.options.dry_run else '') + '.checkpoint'
+    checkpoint = Checkpoint(options.checkpoint or default_checkpoint)
+    if checkpoint.experiment:
+        print("Resuming at experiment", checkpoint.experiment + 1)
+
+    scale = pip_test.start()
+    try:
+        run_plan(plan, scale, checkpoint)
+    except KeyboardInterrupt:
+        pip_test.robot.disable_motors()
+        print("Plan interrupted, run again to resume")
+        raise SystemExit(1)
+    except Exception:
+        print("ERROR OCCURED, run again to resume")
+        pip_test.robot.disable_motors()
+        raise
+    checkpoint.remove()
+    pip_test.finish()
@@ -0,0 +1,364 @@
+#!/usr/bin/env python
+"""
+Virtual Smoothieboard served over a pseudo-terminal (Linux/macOS only).
+
+Parses the G-codes the driver sends, answers with the same ok framing as
+the real board and holds back M400/G28.2 acks for as long as the moves
+would take with the configured M203.1/M204 limits. This lets
+serial_communication and driver_3_0 run, and be timed, without a robot:
+
+    python virtual_smoothie.py          # serves until Ctrl-C
+    ENABLE_VIRTUAL_SMOOTHIE=true python pip_test.py ...
+
+For dry runs loopback() connects in-process instead, running every line
+as it is written on a simulated clock (see driver_3_0.connect_dry_run).
+
+Unknown codes are answered with an error line. Errors and ALARMs can be
+injected to exercise the driver's error handling; after an ALARM the
+board is halted, answering everything but M999 with ALARM lines:
+
+    smoothie.inject_error('Unsupported command')    # the next code fails
+    smoothie.inject_alarm('Hard limit +X')          # the next code halts
+
+"""
+import os
+import re
+import time
+import select
+import optparse
+import threading
+from collections import deque
+
+import driver_3_0
+import kinematics
+import serial_communication
+
+ACK = b'ok\r\n'
+ERROR_LINE = 'error:{}\r\n'
+ALARM_LINE = 'ALARM: {}\r\n'
+HALTED_MESSAGE = 'Halted, send M999 to reset'
+RESET_CODE = 'M999'
+
+# A line can hold several codes, e.g. 'G28.2ZABC G28.2X G28.2Y M400'
+GCODE_PATTERN = re.compile(r'([GM]\d+(?:\.\d+)?)([^GM]*)')
+PARAM_PATTERN = re.compile(r'([A-Z])(-?\d*\.?\d*)')
+
+READ_SIZE = 1024
+# plunger axis: the mount axis its pipette rides on
+PLUNGER_MOUNTS = {'B': 'Z', 'C': 'A'}
+POLL_INTERVAL = 0.1
+
+
+def _parse_params(args):
+    '''Returns {letter: value}, value is None for bare axis letters'''
+    return {
+        letter: float(value) if value else None
+        for letter, value in PARAM_PATTERN.findall(args.upper())
+    }
+
+
+class VirtualSmoothie:
+    def __init__(self, time_scale=1.0, clock=time):
+        '''time_scale multiplies every simulated duration, 0 acks at once.
+        clock is the time module or a sim_clock.SimulatedClock'''
+        self.time_scale = time_scale
+        self.clock = clock
+        self.position = {axis: 0 for axis in driver_3_0.AXES}
+        self.motion = kinematics.MotionModel.from_gcode(
+            driver_3_0.DEFAULT_MAX_SPEEDS, driver_3_0.DEFAULT_ACCELERATION)
+        self.currents = kinematics.parse_axis_settings(
+            driver_3_0.DEFAULT_CURRENT)
+        self.steps_per_mm = kinematics.parse_axis_settings(
+            driver_3_0.DEFAULT_STEPS_PER_MM)
+        self.feed_rate = None
+        self.relative = False
+        self.motors_enabled = True
+        # set by an ALARM, cleared by M999
+        self.halted = False
+        self.port = None
+        # called as listener(plunger, distance, mount_height, at) for every
+        # plunger move, at is the clock.monotonic() the move finishes
+        self.plunger_listeners = []
+        self._busy_until = 0
+        self._master = None
+        self._slave = None
+        self._thread = None
+        self._running = False
+        self._loopback = None
+        # (ALARM_LINE or ERROR_LINE, message) answering the next codes
+        self._faults = deque()
+        self._handlers = {
+            'G0': self._move,
+            'G4': self._dwell,
+            'G28.2': self._home,
+            'G90': self._absolute,
+            'G91': self._relative,
+            'M114.2': self._report_position,
+            'M119': self._report_switches,
+            'M17': self._enable_motors,
+            'M18': self._disable_motors,
+            'M203.1': self._set_max_speeds,
+            'M204': self._set_acceleration,
+            'M400': self._wait,
+            'M907': self._set_current,
+            'M92': self._set_steps_per_mm,
+            RESET_CODE: self._reset,
+        }
+
+    # ----------- Serving --------------- #
+
+    def start(self):
+        '''Opens the pseudo-terminal and returns the port to connect to'''
+        import tty
+        self._master, self._slave = os.openpty()
+        # no echo or newline translation, like a USB serial device
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._running = True
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+        return self.port
+
+    def loopback(self):
+        '''Returns a serial-like connection to this board in the same
+        process, instead of serving a pseudo-terminal'''
+        self._loopback = LoopbackConnection(self)
+        return self._loopback
+
+    def stop(self):
+        self._running = False
+        if self._thread:
+            self._thread.join()
+        for fd in (self._master, self._slave):
+            if fd is not None:
+                os.close(fd)
+        self._master = self._slave = self._thread = None
+
+    def _serve(self):
+        pending = b''
+        while self._running:
+            readable, _, _ = select.select(
+                [self._master], [], [], POLL_INTERVAL)
+            if not readable:
+                continue
+            try:
+                pending += os.read(self._master, READ_SIZE)
+            except OSError:
+                # the other end was closed
+                return
+            *lines, pending = pending.split(b'\n')
+            for line in lines:
+                self.handle_line(line.strip().decode())
+
+    def _write(self, response):
+        if self._loopback is not None:
+            self._loopback.feed(response)
+        else:
+            os.write(self._master, response)
+
+    # ----------- G-code handling --------------- #
+
+    def inject_error(self, message='Injected error'):
+        '''The next code is answered with an error line and its ack'''
+        self._faults.append((ERROR_LINE, message))
+
+    def inject_alarm(self, message='Injected alarm'):
+        '''The next code raises an ALARM, halting the board until M999'''
+        self._faults.append((ALARM_LINE, message))
+
+    def handle_line(self, line):
+        '''Runs every code on the line, acking each one as it completes.
+        Like the board, nothing after an ALARM on the line is run or acked'''
+        for code, args in GCODE_PATTERN.findall(line):
+            if self.halted and code != RESET_CODE:
+                self._write(ALARM_LINE.format(HALTED_MESSAGE).encode())
+                return
+            handler = self._handlers.get(code)
+            if self._faults and code != RESET_CODE:
+                fault, message = self._faults.popleft()
+            elif handler is None:
+                fault, message = ERROR_LINE, 'Unsupported command ' + code
+            else:
+                fault = None
+            if fault == ALARM_LINE:
+                self.halted = True
+                self._write(ALARM_LINE.format(message).encode())
+                return
+            if fault == ERROR_LINE:
+                self._write(ERROR_LINE.format(message).encode() + ACK)
+                continue
+            response = handler(_parse_params(args))
+            self._write((response or b'') + ACK)
+
+    def _sleep_until(self, deadline):
+        if self._loopback is not None:
+            # the host is not blocked, only the acks after this wait
+            self._loopback.hold_until(deadline)
+            return
+        remaining = deadline - self.clock.monotonic()
+        if remaining > 0:
+            self.clock.sleep(remaining)
+
+    def _queue_motion(self, duration):
+        # like the planner queue, moves are acked at once and run in order
+        start = max(self.clock.monotonic(), self._busy_until)
+        self._busy_until = start + duration * self.time_scale
+
+    def _move(self, params):
+        if params.get('F'):
+            self.feed_rate = params['F']
+        target = {
+            axis: value + (self.position[axis] if self.relative else 0)
+            for axis, value in params.items()
+            if axis in driver_3_0.AXES and value is not None
+        }
+        self._queue_motion(
+            self.motion.duration(self.position, target, self.feed_rate))
+        for plunger, mount in PLUNGER_MOUNTS.items():
+            distance = target.get(plunger, self.position[plunger]) \
+                - self.position[plunger]
+            if distance:
+                for listener in self.plunger_listeners:
+                    listener(plunger, distance,
+                             target.get(mount, self.position[mount]),
+                             self._busy_until)
+        self.position.update(target)
+
+    def _dwell(self, params):
+        self._queue_motion(params.get('P') or 0)
+
+    def _home(self, params):
+        # homing blocks until done
+        self._sleep_until(self._busy_until)
+        target = {
+            axis: driver_3_0.HOMED_POSITION[axis]
+            for axis in params if axis in driver_3_0.AXES
+        }
+        self._queue_motion(self.motion.duration(self.position, target))
+        self._sleep_until(self._busy_until)
+        self.position.update(target)
+
+    def _reset(self, params):
+        self.halted = False
+
+    def _enable_motors(self, params):
+        self.motors_enabled = True
+
+    def _disable_motors(self, params):
+        self.motors_enabled = False
+
+    def _absolute(self, params):
+        self.relative = False
+
+    def _relative(self, params):
+        self.relative = True
+
+    def _wait(self, params):
+        self._sleep_until(self._busy_until)
+
+    def _report_position(self, params):
+        values = ' '.join(
+            '{}:{:.4f}'.format(axis, self.position[axis])
+            for axis in driver_3_0.AXES)
+        return 'ok MCS: {}\r\n'.format(values).encode()
+
+    def _report_switches(self, params):
+        values = ' '.join(
+            '{}_max:0'.format(axis) for axis in driver_3_0.AXES)
+        return '{}\r\n'.format(values).encode()
+
+    def _set_max_speeds(self, params):
+        self._update_settings(self.motion.max_speeds, params)
+
+    def _set_acceleration(self, params):
+        self._update_settings(self.motion.acceleration, params)
+
+    def _set_current(self, params):
+        self._update_settings(self.currents, params)
+
+    def _set_steps_per_mm(self, params):
+        self._update_settings(self.steps_per_mm, params)
+
+    def _update_settings(self, settings, params):
+        settings.update({
+            axis: value for axis, value in params.items()
+            if axis in driver_3_0.AXES and value is not None
+        })
+
+
+class LoopbackConnection:
+    '''The parts of serial.Serial the driver uses. Written lines run on the
+    VirtualSmoothie at once, but a response is only readable from the
+    clock time the board would send it at, and reading sleeps on the clock
+    until then. On a simulated clock nothing waits in real time. Every line
+    is kept in trace as (clock.monotonic(), line)'''
+    def __init__(self, smoothie):
+        self.smoothie = smoothie
+        self.clock = smoothie.clock
+        self.timeout = serial_communication.DEFAULT_SERIAL_TIMEOUT
+        self.trace = []
+        self._pending = b''
+        # [ready at, bytes] of every response not read yet
+        self._responses = deque()
+        self._ready_at = 0
+
+    @property
+    def in_waiting(self):
+        now = self.clock.monotonic()
+        return sum(len(response) for ready_at, response in self._responses
+                   if ready_at <= now)
+
+    def write(self, data):
+        self._pending += data
+        *lines, self._pending = self._pending.split(b'\n')
+        for line in lines:
+            line = line.strip().decode()
+            self.trace.append((self.clock.monotonic(), line))
+            self.smoothie.handle_line(line)
+        return len(data)
+
+    def hold_until(self, deadline):
+        '''Responses from now on are sent at deadline at the earliest'''
+        self._ready_at = max(self._ready_at, deadline)
+
+    def feed(self, response):
+        self._responses.append([
+            max(self._ready_at, self.clock.monotonic()), bytearray(response)])
+
+    def read(self, size=1):
+        if not self._responses:
+            return b''
+        remaining = self._responses[0][0] - self.clock.monotonic()
+        if remaining > 0:
+            self.clock.sleep(remaining)
+        now = self.clock.monotonic()
+        data = bytearray()
+        while self._responses and len(data) < size \
+                and self._responses[0][0] <= now:
+            response = self._responses[0][1]
+            taken = response[:size - len(data)]
+            data += taken
+            del response[:len(taken)]
+            if not response:
+                self._responses.popleft()
+        return bytes(data)
+
+    def reset_input_buffer(self):
+        self._responses.clear()
+
+    def close(self):
+        pass
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage='usage: %prog [options] ')
+    parser.add_option("-t", "--time_scale", dest = "time_scale", type = 'float', default = 1.0, help = "Multiplier for simulated move durations, 0 for instant")
+    (options, args) = parser.parse_args(args = None, values = None)
+
+    smoothie = VirtualSmoothie(time_scale = options.time_scale)
+    print("Virtual Smoothie on", smoothie.start())
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        smoothie.stop()